@@ -0,0 +1,53 @@
+import functools
+import os
+
+import numpy as np
+from rembg import new_session, remove
+from rembg.sessions import sessions_class
+
+REMBG_MODEL = os.environ.get("REMBG_MODEL", "u2net")
+
+
+def download_model(model=REMBG_MODEL):
+    """Fetch the model weights without loading them, so that worker
+    processes starting together don't all download the same file."""
+    for session_class in sessions_class:
+        if session_class.name() == model:
+            return session_class.download_models()
+    raise ValueError(f"unknown rembg model {model!r}")
+
+
+@functools.lru_cache(maxsize=None)
+def get_session(model=REMBG_MODEL):
+    """The rembg session for this process, loaded once and reused."""
+    return new_session(model)
+
+
+def warm_up(model=REMBG_MODEL):
+    """Load the session and run it once, so the first request doesn't pay
+    for it. Used as the worker pool initializer."""
+    try:
+        remove(np.zeros((32, 32, 3), dtype=np.uint8), session=get_session(model))
+    except Exception as e:
+        # keep the worker alive for the other jobs, removal retries the load
+        print(f"rembg warm up failed: {e}")
+
+
+def remove_background(image, model=REMBG_MODEL):
+    """Cut out the foreground of an RGB image, returns an RGBA image."""
+    return remove(image, session=get_session(model))
+
+
+def remove_background_batch(*images, model=REMBG_MODEL):
+    """remove_background over several images in one job.
+
+    Returns the RGBA results flattened and concatenated, split them with
+    batch_shapes.
+    """
+    session = get_session(model)
+    return np.concatenate([remove(image, session=session).ravel() for image in images])
+
+
+def batch_shapes(images):
+    """Output shape of each image in a remove_background_batch job."""
+    return [image.shape[:2] + (4,) for image in images]
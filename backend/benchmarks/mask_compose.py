@@ -0,0 +1,79 @@
+"""Compare the /sam/detect mask compositing against the PIL one it replaced.
+
+Both the compositing alone and the whole step, decoding the ComfyUI images
+and encoding the preview and the upload, are timed. Run from the backend
+directory:
+    python -m benchmarks.mask_compose
+"""
+import io
+import time
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from masks import compose_detect, composite, composite_pil, encode_png
+
+
+def make_inputs(size, mode):
+    """Photo like original (blurred noise compresses about as well as a
+    photo, plain noise doesn't) and a round mask, PNG encoded."""
+    rng = np.random.default_rng(0)
+    noise = rng.integers(0, 256, (size, size, len(mode)), dtype=np.uint8)
+    original = cv2.GaussianBlur(noise, (0, 0), size / 64)
+    original = cv2.normalize(original, None, 0, 255, cv2.NORM_MINMAX)
+    y, x = np.ogrid[:size, :size]
+    blob = (y - size / 2) ** 2 + (x - size / 3) ** 2 < (size / 4) ** 2
+    mask = np.where(blob, 255, 0).astype(np.uint8)
+    return (
+        encode_png(Image.fromarray(original, mode)),
+        encode_png(Image.fromarray(mask, "L")),
+    )
+
+
+def pil_compose_detect(image_bytes, fetch_img_bytes):
+    """What detect did before, minus the temp files."""
+    mask_image_r = Image.open(io.BytesIO(image_bytes)).convert("L")
+    original_image = Image.open(io.BytesIO(fetch_img_bytes))
+    mask_preview, masked = composite_pil(original_image, mask_image_r)
+    return encode_png(mask_preview), encode_png(masked)
+
+
+def timed(fn, *args, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def decoded(png):
+    return np.asarray(Image.open(io.BytesIO(png)))
+
+
+if __name__ == "__main__":
+    for mode in ("RGB", "RGBA"):
+        for size in (512, 1024, 2048, 4096):
+            original_png, mask_png = make_inputs(size, mode)
+            original_image = Image.open(io.BytesIO(original_png))
+            original_image.load()
+            mask_image = Image.open(io.BytesIO(mask_png))
+            mask_image.load()
+            # composite works on cv2's BGR(A) order, the result is the same
+            original = cv2.imdecode(
+                np.frombuffer(original_png, dtype=np.uint8), cv2.IMREAD_UNCHANGED
+            )
+
+            pil, _ = timed(composite_pil, original_image, mask_image)
+            fused, _ = timed(composite, original, np.asarray(mask_image))
+            pil_total, expected = timed(pil_compose_detect, mask_png, original_png)
+            total, result = timed(compose_detect, mask_png, original_png)
+            for a, b in zip(expected, result):
+                assert np.array_equal(decoded(a), decoded(b))
+            print(
+                f"{mode:4} {size}x{size}: composite pil {pil * 1000:7.1f}ms "
+                f"cv2 {fused * 1000:6.1f}ms | with decoding and encoding "
+                f"pil {pil_total * 1000:7.1f}ms cv2 {total * 1000:7.1f}ms "
+                f"({pil_total / total:4.1f}x)"
+            )
@@ -0,0 +1,61 @@
+"""Compare time and peak RSS of the poisson solvers across image sizes.
+
+Every run happens in a fresh process so the peak RSS is its own. Run from
+the backend directory:
+    python -m benchmarks.poisson_solvers --sizes 512 1024 2048 4096
+"""
+import argparse
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import cv2
+import numpy as np
+
+from poisson import SOLVERS, poisson_edit
+
+
+def make_images(size):
+    rng = np.random.default_rng(0)
+    source = rng.integers(0, 256, (size, size, 3), dtype=np.uint8)
+    target = rng.integers(0, 256, (size, size, 3), dtype=np.uint8)
+    source = cv2.GaussianBlur(source, (0, 0), 5)
+    target = cv2.GaussianBlur(target, (0, 0), 9)
+    mask = np.zeros((size, size), dtype=np.uint8)
+    cv2.circle(mask, (size // 2, size // 2), size // 3, 255, -1)
+    return source, target, mask
+
+
+def run(size, solver, tol):
+    source, target, mask = make_images(size)
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    poisson_edit(source, target, mask, (0, 0), solver=solver, tol=tol)
+    elapsed = time.perf_counter() - start
+    # ru_maxrss is in KiB on linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return elapsed, peak / 1024, (peak - baseline) / 1024
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[512, 1024, 2048])
+    parser.add_argument("--solvers", nargs="+", default=list(SOLVERS))
+    parser.add_argument("--tol", type=float, default=1e-5)
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        for solver in args.solvers:
+            with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as pool:
+                try:
+                    elapsed, peak, grown = pool.submit(
+                        run, size, solver, args.tol
+                    ).result()
+                except Exception as e:
+                    print(f"{size}x{size} {solver:>9}: failed ({e!r})")
+                    continue
+            print(
+                f"{size}x{size} {solver:>9}: {elapsed:7.2f}s  "
+                f"peak rss {peak:7.0f} MiB (+{grown:.0f} MiB for the solve)"
+            )
@@ -0,0 +1,179 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Least recently used cache bounded by the total size of its values.
+
+    size is a function returning the size in bytes of a value. Values larger
+    than the whole budget are not cached. With ttl set, entries also expire
+    that many seconds after they were put. Safe to share between threads.
+    """
+
+    def __init__(self, max_bytes, size, ttl=None):
+        self.max_bytes = max_bytes
+        self.size = size
+        self.ttl = ttl
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and self._expired(item):
+                self._remove(key)
+                self.expirations += 1
+                item = None
+            return item is not None
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and self._expired(item):
+                self._remove(key)
+                self.expirations += 1
+                item = None
+            if item is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._items.move_to_end(key)
+            return item[0]
+
+    def put(self, key, value):
+        nbytes = self.size(value)
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            self._remove(key)
+            self._sweep()
+            if nbytes > self.max_bytes:
+                return
+            self._items[key] = (value, nbytes, expires)
+            self.bytes += nbytes
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self._items)))
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._items.get(key)
+            self._remove(key)
+            if item is None or self._expired(item):
+                return default
+            return item[0]
+
+    def get_or_create(self, key, create):
+        """Return the cached value for key, calling create() on a miss."""
+        value = self.get(key)
+        if value is None:
+            value = create()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.bytes = 0
+
+    def _expired(self, item):
+        return item[2] is not None and item[2] <= time.monotonic()
+
+    def _remove(self, key):
+        item = self._items.pop(key, None)
+        if item is not None:
+            self.bytes -= item[1]
+
+    def _sweep(self):
+        if self.ttl is None:
+            return
+        for key in [key for key, item in self._items.items() if self._expired(item)]:
+            self._remove(key)
+            self.expirations += 1
+
+    def stats(self):
+        return {
+            "entries": len(self._items),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+def content_key(data, **params):
+    """Content address of an operation on data, a hex digest of the bytes and
+    of params, which have to be JSON serializable."""
+    digest = hashlib.blake2b(data, digest_size=20)
+    digest.update(json.dumps(params, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """Cache of encoded results (bytes) keyed by content_key.
+
+    Entries are kept in memory in an LRUCache of max_bytes. With directory
+    set they are also written to disk under ab/cd/<key>, so that they
+    survive restarts and no single directory grows too large, and disk hits
+    are promoted back to memory. The disk tier is never pruned, clear the
+    directory out of band if it grows too large.
+    """
+
+    def __init__(self, max_bytes, directory=None):
+        self.memory = LRUCache(max_bytes, len)
+        self.directory = directory
+        self.disk_hits = 0
+        self.disk_errors = 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key[2:4], key)
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is not None or self.directory is None:
+            return value
+        try:
+            with open(self._path(key), "rb") as f:
+                value = f.read()
+        except FileNotFoundError:
+            return None
+        self.disk_hits += 1
+        self.memory.put(key, value)
+        return value
+
+    def put(self, key, value):
+        self.memory.put(key, value)
+        if self.directory is None:
+            return
+        path = self._path(key)
+        temp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(temp, "wb") as f:
+                f.write(value)
+            # readers only ever see complete files
+            os.replace(temp, path)
+        except OSError as e:
+            self.disk_errors += 1
+            print(f"Could not write cached result {key}: {e}")
+
+    def stats(self):
+        return {
+            **self.memory.stats(),
+            "directory": self.directory,
+            "disk_hits": self.disk_hits,
+            "disk_errors": self.disk_errors,
+        }
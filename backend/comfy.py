@@ -0,0 +1,69 @@
+import asyncio
+import os
+
+import httpx
+
+COMFY_URI = os.environ.get("COMFY_URI", "http://127.0.0.1:8188/")
+# seconds, the read timeout has to cover a SAM detect on the ComfyUI side
+COMFY_TIMEOUT = float(os.environ.get("COMFY_TIMEOUT", 60))
+COMFY_CONNECT_TIMEOUT = float(os.environ.get("COMFY_CONNECT_TIMEOUT", 5))
+COMFY_RETRIES = int(os.environ.get("COMFY_RETRIES", 2))
+COMFY_MAX_CONNECTIONS = int(os.environ.get("COMFY_MAX_CONNECTIONS", 20))
+
+# gateway errors ComfyUI (or a proxy in front of it) answers while restarting
+RETRY_STATUSES = (502, 503, 504)
+
+
+class ComfyClient:
+    """Async client for the ComfyUI API.
+
+    One per app, its connections are kept alive and shared by all requests.
+    Failing to connect is retried for every request, nothing reached the
+    server yet. Idempotent requests (GETs by default) are also retried on
+    any transport error and on gateway errors, with exponential backoff.
+    """
+
+    def __init__(
+        self,
+        base_url=COMFY_URI,
+        timeout=COMFY_TIMEOUT,
+        connect_timeout=COMFY_CONNECT_TIMEOUT,
+        retries=COMFY_RETRIES,
+        max_connections=COMFY_MAX_CONNECTIONS,
+    ):
+        self.retries = retries
+        self._client = httpx.AsyncClient(
+            base_url=base_url,
+            timeout=httpx.Timeout(timeout, connect=connect_timeout),
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+        )
+
+    async def request(self, method, url, retry=None, **kwargs):
+        if retry is None:
+            retry = method == "GET"
+        for attempt in range(self.retries + 1):
+            last = attempt == self.retries
+            try:
+                response = await self._client.request(method, url, **kwargs)
+            except (httpx.ConnectError, httpx.ConnectTimeout):
+                if last:
+                    raise
+            except httpx.TransportError:
+                if last or not retry:
+                    raise
+            else:
+                if last or not retry or response.status_code not in RETRY_STATUSES:
+                    return response
+            await asyncio.sleep(0.1 * 2**attempt)
+
+    async def get(self, url, **kwargs):
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request("POST", url, **kwargs)
+
+    async def aclose(self):
+        await self._client.aclose()
@@ -0,0 +1,324 @@
+import asyncio
+import heapq
+import itertools
+import os
+import statistics
+import time
+import uuid
+from collections import Counter, deque
+
+import httpx
+
+from cache import LRUCache
+from workers import QueueFull
+
+# seconds between checks of the ComfyUI queue while jobs are outstanding
+COMFY_POLL_INTERVAL = float(os.environ.get("COMFY_POLL_INTERVAL", 0.25))
+# how long finished jobs and their result stay available
+JOB_TTL = float(os.environ.get("JOB_TTL", 30 * 60))
+JOB_RESULT_BYTES = int(os.environ.get("JOB_RESULT_BYTES", 256 * 1024**2))
+# jobs handed to ComfyUI at once, enough to keep its queue fed, and jobs
+# waiting here before new ones are turned away
+COMFY_MAX_IN_FLIGHT = int(os.environ.get("COMFY_MAX_IN_FLIGHT", 2))
+COMFY_MAX_QUEUED = int(os.environ.get("COMFY_MAX_QUEUED", 64))
+# polls a job can be missing from both the queue and the history, ie. lost
+# to a ComfyUI restart, before it is failed
+LOST_AFTER = 8
+# recent jobs the wait and run time metrics are computed over
+METRICS_WINDOW = 200
+
+
+class WorkflowError(Exception):
+    """ComfyUI refused the workflow."""
+
+
+class Job:
+    """A workflow run, from the local queue until ComfyUI has run it.
+
+    status goes scheduled (local queue), queued (ComfyUI queue), running,
+    then done, failed or invalid (ComfyUI refused the workflow).
+    """
+
+    def __init__(self, workflow, user=None, priority=0):
+        self.id = uuid.uuid4().hex
+        self.prompt_id = None
+        self.workflow = workflow
+        self.user = user
+        self.priority = priority
+        self.status = "scheduled"
+        self.submitted = time.time()
+        self.dispatched = None
+        self.started = None
+        self.finished = None
+        self.outputs = []
+        self.image = None
+        self.media_type = None
+        self.error = None
+        self.done = asyncio.Event()
+        self._missing = 0
+
+    def nbytes(self):
+        return 1024 + (len(self.image) if self.image else 0)
+
+    def info(self):
+        return {
+            "job_id": self.id,
+            "prompt_id": self.prompt_id,
+            "status": self.status,
+            "priority": self.priority,
+            "submitted": self.submitted,
+            "dispatched": self.dispatched,
+            "started": self.started,
+            "finished": self.finished,
+            "outputs": self.outputs,
+            "error": self.error,
+        }
+
+
+def output_images(entry):
+    """Image references of a history entry, saved outputs first."""
+    images = [
+        image
+        for node in entry.get("outputs", {}).values()
+        for image in node.get("images", [])
+    ]
+    return sorted(images, key=lambda image: image.get("type") != "output")
+
+
+def summary(values):
+    if not values:
+        return None
+    values = sorted(values)
+    return {
+        "mean": statistics.fmean(values),
+        "p50": values[len(values) // 2],
+        "p95": values[min(int(len(values) * 0.95), len(values) - 1)],
+        "max": values[-1],
+    }
+
+
+class JobTracker:
+    """Follows workflows submitted to ComfyUI until it has run them.
+
+    While jobs are outstanding a single watcher polls /queue, which lists
+    the running and pending prompt_ids, so the cost doesn't grow with the
+    number of jobs. A job leaving the queue is looked up in /history, and
+    its first saved image is fetched from /view. Waiters are woken through
+    the job's done event.
+    """
+
+    def __init__(self, comfy, poll_interval=COMFY_POLL_INTERVAL, ttl=JOB_TTL):
+        self.comfy = comfy
+        self.poll_interval = poll_interval
+        self.jobs = LRUCache(JOB_RESULT_BYTES, Job.nbytes, ttl=ttl)
+        self._active = {}
+        self._pending = {}
+        self._watcher = None
+
+    async def submit(self, job):
+        self._active[job.id] = job
+        res = await self.comfy.post("prompt", json={"prompt": job.workflow})
+        if res.status_code != 200:
+            raise WorkflowError(res.text)
+        job.prompt_id = res.json()["prompt_id"]
+        job.status = "queued"
+        job.dispatched = time.time()
+        job.workflow = None
+        self._pending[job.prompt_id] = job
+        if self._watcher is None or self._watcher.done():
+            self._watcher = asyncio.create_task(self._watch())
+        return job
+
+    def get(self, job_id):
+        return self._active.get(job_id) or self.jobs.get(job_id)
+
+    async def wait(self, job, timeout=None):
+        await asyncio.wait_for(job.done.wait(), timeout)
+        return job
+
+    async def _watch(self):
+        while self._pending:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                queue = (await self.comfy.get("queue")).json()
+            except (httpx.HTTPError, ValueError) as e:
+                print(f"Could not poll the ComfyUI queue: {e}")
+                continue
+            running = {item[1] for item in queue.get("queue_running", [])}
+            queued = {item[1] for item in queue.get("queue_pending", [])}
+            left = []
+            for prompt_id, job in self._pending.items():
+                if prompt_id in running:
+                    if job.status == "queued":
+                        job.status = "running"
+                        job.started = time.time()
+                elif prompt_id not in queued:
+                    left.append(job)
+            await asyncio.gather(*(self._collect(job) for job in left))
+
+    async def _collect(self, job):
+        try:
+            history = (await self.comfy.get(f"history/{job.prompt_id}")).json()
+        except (httpx.HTTPError, ValueError) as e:
+            print(f"Could not fetch the ComfyUI history of {job.prompt_id}: {e}")
+            return
+        entry = history.get(job.prompt_id)
+        if entry is None:
+            job._missing += 1
+            if job._missing >= LOST_AFTER:
+                self._finish(job, "ComfyUI lost the job")
+            return
+
+        job.outputs = output_images(entry)
+        status = entry.get("status", {})
+        if status.get("status_str") == "error":
+            self._finish(job, status.get("messages"))
+        elif not job.outputs:
+            self._finish(job, "The workflow produced no images")
+        else:
+            await self._fetch(job)
+
+    async def _fetch(self, job):
+        try:
+            res = await self.comfy.get("view", params=job.outputs[0])
+            res.raise_for_status()
+        except httpx.HTTPError as e:
+            self._finish(job, f"Could not fetch the result: {e}")
+        else:
+            job.image = res.content
+            job.media_type = res.headers.get("content-type", "image/png")
+            self._finish(job)
+
+    def _finish(self, job, error=None, status=None):
+        self._active.pop(job.id, None)
+        self._pending.pop(job.prompt_id, None)
+        job.status = status or ("failed" if error else "done")
+        job.error = error
+        job.workflow = None
+        job.finished = time.time()
+        job.started = job.started or job.dispatched or job.finished
+        self.jobs.put(job.id, job)
+        job.done.set()
+
+
+class JobScheduler(JobTracker):
+    """JobTracker with a bounded priority queue in front of ComfyUI.
+
+    At most max_in_flight jobs are handed to ComfyUI at once, the rest wait
+    here, and with max_queued waiting schedule raises QueueFull. Lower
+    priorities go first. Within a priority users take turns: a job ranks
+    behind the user's jobs that are still queued or running, so one user
+    submitting a burst doesn't hold up everyone else.
+    """
+
+    def __init__(
+        self,
+        comfy,
+        max_in_flight=COMFY_MAX_IN_FLIGHT,
+        max_queued=COMFY_MAX_QUEUED,
+        **kwargs,
+    ):
+        super().__init__(comfy, **kwargs)
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.in_flight = 0
+        self.scheduled = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.wait_times = deque(maxlen=METRICS_WINDOW)
+        self.run_times = deque(maxlen=METRICS_WINDOW)
+        self._queue = []
+        self._keys = {}
+        self._users = Counter()
+        self._seq = itertools.count()
+        self._tasks = set()
+
+    def schedule(self, workflow, user=None, priority=0):
+        if len(self._queue) >= self.max_queued:
+            self.rejected += 1
+            raise QueueFull()
+        job = Job(workflow, user, priority)
+        key = (priority, self._users[user], next(self._seq))
+        self._users[user] += 1
+        self._keys[job.id] = key
+        heapq.heappush(self._queue, (key, job))
+        self._active[job.id] = job
+        self.scheduled += 1
+        self._dispatch()
+        return job
+
+    def _dispatch(self):
+        while self._queue and self.in_flight < self.max_in_flight:
+            _, job = heapq.heappop(self._queue)
+            del self._keys[job.id]
+            job.status = "queued"
+            self.in_flight += 1
+            self.wait_times.append(time.time() - job.submitted)
+            task = asyncio.create_task(self._submit(job))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _submit(self, job):
+        try:
+            await self.submit(job)
+        except WorkflowError as e:
+            self._finish(job, str(e), status="invalid")
+        except httpx.HTTPError as e:
+            self._finish(job, f"Could not submit the workflow: {e!r}")
+        except (ValueError, KeyError) as e:
+            # a 200 that isn't JSON or has no prompt_id, from ComfyUI or a
+            # proxy in front of it; unhandled it would hold its slot forever
+            self._finish(job, f"Unexpected reply to the workflow: {e!r}")
+
+    def _finish(self, job, error=None, status=None):
+        super()._finish(job, error, status)
+        self.in_flight -= 1
+        self._users[job.user] -= 1
+        if not self._users[job.user]:
+            del self._users[job.user]
+        if error:
+            self.failed += 1
+        else:
+            self.completed += 1
+            self.run_times.append(job.finished - job.started)
+        self._dispatch()
+
+    def position(self, job):
+        """Jobs ahead of job in the local queue, None once dispatched."""
+        key = self._keys.get(job.id)
+        if key is None:
+            return None
+        return sum(1 for other, _ in self._queue if other < key)
+
+    def eta(self, job):
+        """Rough seconds until job is done, assuming ComfyUI runs one job at
+        a time at the recent mean run time."""
+        if job.done.is_set() or not self.run_times:
+            return None
+        run_time = statistics.fmean(self.run_times)
+        position = self.position(job)
+        if position is None:
+            if job.status == "running":
+                return max(run_time - (time.time() - job.started), 0)
+            return run_time
+        return (position + self.in_flight + 1) * run_time
+
+    def info(self, job):
+        return {**job.info(), "position": self.position(job), "eta": self.eta(job)}
+
+    def stats(self):
+        return {
+            "depth": len(self._queue),
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "max_queued": self.max_queued,
+            "users": len(self._users),
+            "scheduled": self.scheduled,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "wait_time": summary(self.wait_times),
+            "run_time": summary(self.run_times),
+            "results": self.jobs.stats(),
+        }
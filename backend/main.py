@@ -1,26 +1,56 @@
-from fastapi import Depends, FastAPI, HTTPException, UploadFile, status, Response
-from fastapi.responses import StreamingResponse
+from fastapi import (
+    Depends,
+    FastAPI,
+    HTTPException,
+    Request,
+    Response,
+    UploadFile,
+    status,
+)
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
 from typing import List
 from routes import auth
 import uvicorn
-import requests
+import httpx
 import base64
-from PIL import Image, ImageEnhance
+from PIL import Image
 from io import BytesIO
 import os
+import asyncio
 import io
-import time
-from rembg import remove
+import json
+import secrets
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import cv2
-import scipy.sparse
-from scipy.sparse.linalg import spsolve
+import background
+from cache import LRUCache, ResultCache, content_key
+from comfy import ComfyClient
+from jobs import JobScheduler
+from masks import compose_detect
+from poisson import BLEND_MODES, SOLVERS, cache_stats, poisson_edit
+from workers import JobTimeout, QueueFull, WorkerCrashed, WorkerPool
 
-COMFY_URI = "http://127.0.0.1:8188/"
 app = FastAPI()
 
+# decoded RGBA sources from /blend/upload, looked up by the returned token
+BLEND_SESSIONS = LRUCache(512 * 1024**2, lambda image: image.nbytes, ttl=30 * 60)
+
+# /sam/detect mask previews (PNG) by file name, served by /sam/preview
+MASK_PREVIEWS = LRUCache(
+    int(os.environ.get("MASK_PREVIEW_BYTES", 64 * 1024**2)), len, ttl=30 * 60
+)
+
+# encoded /removebackground and /sam/detect results by content_key, optionally
+# persisted under RESULT_CACHE_DIR
+RESULTS = ResultCache(
+    int(os.environ.get("RESULT_CACHE_BYTES", 256 * 1024**2)),
+    os.environ.get("RESULT_CACHE_DIR"),
+)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -31,209 +61,308 @@ app.add_middleware(
 
 app.include_router(auth.router)
 
-
-class SAMDetect(BaseModel):
-    image_path: str
-    positive_points: List[List[float]]
-    negative_points: List[List[float]]
-    threshold: float
+# process pool for the CPU heavy handlers and pooled ComfyUI connections,
+# both started with the app
+workers = None
+comfy = None
+jobs = None
+# seconds /output waits for its workflow before telling the client to poll
+COMFY_JOB_TIMEOUT = float(os.environ.get("COMFY_JOB_TIMEOUT", 600))
 
 
-def laplacian_matrix(n, m):
-    """Generate the Poisson matrix.
+@app.on_event("startup")
+def start_workers():
+    global workers
+    try:
+        background.download_model()
+    except Exception as e:
+        print(f"Could not download the rembg model: {e}")
+    # every worker loads its own rembg session once, up front
+    workers = WorkerPool(initializer=background.warm_up)
+    workers.warm_up()
 
-    Refer to:
-    https://en.wikipedia.org/wiki/Discrete_Poisson_equation
 
-    Note: it's the transpose of the wiki's matrix
-    """
-    mat_D = scipy.sparse.lil_matrix((m, m))
-    mat_D.setdiag(-1, -1)
-    mat_D.setdiag(4)
-    mat_D.setdiag(-1, 1)
+@app.on_event("startup")
+async def start_comfy():
+    global comfy, jobs
+    comfy = ComfyClient()
+    jobs = JobScheduler(comfy)
 
-    mat_A = scipy.sparse.block_diag([mat_D] * n).tolil()
 
-    mat_A.setdiag(-1, 1 * m)
-    mat_A.setdiag(-1, -1 * m)
+@app.on_event("shutdown")
+def stop_workers():
+    workers.shutdown()
 
-    return mat_A
 
+@app.on_event("shutdown")
+async def stop_comfy():
+    await comfy.aclose()
 
-def poisson_edit(source, target, mask, offset):
-    """The poisson blending function.
 
-    Refer to:
-    Perez et. al., "Poisson Image Editing", 2003.
-    """
+@app.exception_handler(httpx.TransportError)
+async def comfy_unavailable(request, exc):
+    return JSONResponse(
+        status_code=status.HTTP_502_BAD_GATEWAY,
+        content={"detail": f"ComfyUI request failed: {exc!r}"},
+    )
 
-    # Assume:
-    # target is not smaller than source.
-    # shape of mask is same as shape of target.
-    y_max, x_max = target.shape[:-1]
-    y_min, x_min = 0, 0
 
-    x_range = x_max - x_min
-    y_range = y_max - y_min
+def run_in_worker(fn, inputs, out_shape, **kwargs):
+    try:
+        return workers.run(fn, inputs, out_shape, **kwargs)
+    except QueueFull:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many image jobs queued, try again shortly",
+            headers={"Retry-After": "1"},
+        )
+    except JobTimeout:
+        raise HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail="Image job timed out",
+        )
+    except WorkerCrashed:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="The image worker crashed, try again",
+            headers={"Retry-After": "1"},
+        )
 
-    M = np.float32([[1, 0, offset[0]], [0, 1, offset[1]]])
-    source = cv2.warpAffine(source, M, (x_range, y_range))
 
-    mask = mask[y_min:y_max, x_min:x_max]
-    mask[mask != 0] = 1
-    # mask = cv2.threshold(mask, 127, 1, cv2.THRESH_BINARY)
+def not_modified(request, key):
+    # results are content addressed, a client sending back the key as ETag
+    # already has this exact result
+    return request.headers.get("if-none-match") == f'"{key}"'
 
-    mat_A = laplacian_matrix(y_range, x_range)
 
-    # for \Delta g
-    laplacian = mat_A.tocsc()
+def result_response(key, content, media_type):
+    return Response(content, media_type=media_type, headers={"ETag": f'"{key}"'})
 
-    # set the region outside the mask to identity
-    for y in range(1, y_range - 1):
-        for x in range(1, x_range - 1):
-            if mask[y, x] == 0:
-                k = x + y * x_range
-                mat_A[k, k] = 1
-                mat_A[k, k + 1] = 0
-                mat_A[k, k - 1] = 0
-                mat_A[k, k + x_range] = 0
-                mat_A[k, k - x_range] = 0
 
-    # corners
-    # mask[0, 0]
-    # mask[0, y_range-1]
-    # mask[x_range-1, 0]
-    # mask[x_range-1, y_range-1]
+def encode_png(image):
+    output_binary = io.BytesIO()
+    Image.fromarray(image).save(output_binary, "PNG")
+    return output_binary.getvalue()
 
-    mat_A = mat_A.tocsc()
 
-    mask_flat = mask.flatten()
-    for channel in range(source.shape[2]):
-        source_flat = source[y_min:y_max, x_min:x_max, channel].flatten()
-        target_flat = target[y_min:y_max, x_min:x_max, channel].flatten()
+def merge_stats(stats):
+    return {key: sum(s[key] for s in stats) for key in stats[0]}
 
-        # concat = source_flat*mask_flat + target_flat*(1-mask_flat)
 
-        # inside the mask:
-        # \Delta f = div v = \Delta g
-        alpha = 1
-        mat_b = laplacian.dot(source_flat) * alpha
+class SAMDetect(BaseModel):
+    image_path: str
+    positive_points: List[List[float]]
+    negative_points: List[List[float]]
+    threshold: float
 
-        # outside the mask:
-        # f = t
-        mat_b[mask_flat == 0] = target_flat[mask_flat == 0]
 
-        x = spsolve(mat_A, mat_b)
-        # print(x.shape)
-        x = x.reshape((y_range, x_range))
-        # print(x.shape)
-        x[x > 255] = 255
-        x[x < 0] = 0
-        x = x.astype("uint8")
-        # x = cv2.normalize(x, alpha=0, beta=255, norm_type=cv2.NORM_MINMAX)
-        # print(x.shape)
+def detect_etag_key(key, inline):
+    # the inline response carries the preview as well, a client holding the
+    # plain one mustn't get a 304 for it
+    return key + "-inline" if inline else key
 
-        target[y_min:y_max, x_min:x_max, channel] = x
 
-    return target
+def detect_response(key, content, preview, inline):
+    etag_key = detect_etag_key(key, inline)
+    if not inline:
+        return result_response(etag_key, content, "application/json")
+    res = json.loads(content)
+    preview = base64.b64encode(preview)
+    res["mask_preview"] = "data:image/png;base64," + preview.decode("utf-8")
+    return result_response(etag_key, json.dumps(res).encode(), "application/json")
 
 
 @app.post("/sam/detect")
-def detect(sam_detect: SAMDetect):
-    detect_uri = COMFY_URI + "sam/detect"
-    fetch_img_uri = COMFY_URI + "view"
-    img_upload_uri = COMFY_URI + "upload/image"
-
+async def detect(sam_detect: SAMDetect, request: Request, inline: bool = False):
     detect_json = {
         "positive_points": sam_detect.positive_points,
         "negative_points": sam_detect.negative_points,
         "threshold": sam_detect.threshold,
     }
-    detect_res = requests.post(detect_uri, json=detect_json)
-    image_bytes = detect_res.content
-    image_base64 = base64.b64encode(image_bytes).decode("utf-8")
-
-    mask_image_r = Image.open(BytesIO(image_bytes)).convert("L")
-    mask_image = mask_image_r.point(lambda p: 255 - p)
-
     query_params = {"filename": sam_detect.image_path, "type": "input"}
-    fetch_img_res = requests.get(fetch_img_uri, params=query_params)
+
+    fetch_img_res = await comfy.get("view", params=query_params)
     fetch_img_bytes = fetch_img_res.content
-    original_image = Image.open(BytesIO(fetch_img_bytes))
 
-    mask_image_rgb = mask_image_r.point(lambda p: p > 128 and 255)
-    dull_image = ImageEnhance.Brightness(original_image).enhance(0.3)
-    mask_preview = Image.composite(original_image, dull_image, mask_image_rgb)
+    key = content_key(fetch_img_bytes, op="sam/detect", **detect_json)
+    # named after the key, so cached results point at their own preview
+    mask_filename = key + ".png"
+    if not_modified(request, detect_etag_key(key, inline)):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED)
+    content = RESULTS.get(key)
+    # the preview can expire or be evicted before the result, a result
+    # without one is run again
+    preview_bytes = None if content is None else MASK_PREVIEWS.get(mask_filename)
+    if preview_bytes is not None:
+        return detect_response(key, content, preview_bytes, inline)
+
+    # only started on a miss: cancelling the request doesn't stop ComfyUI
+    # running the detect, so overlapping it with the fetch above would cost
+    # a full detect on every hit to save a round trip on misses
+    detect_res = await comfy.post("sam/detect", json=detect_json)
+
+    preview_bytes, upload_bytes = await run_in_threadpool(
+        compose_detect, detect_res.content, fetch_img_bytes
+    )
+    MASK_PREVIEWS.put(mask_filename, preview_bytes)
+    files = {"image": ("temp.png", upload_bytes, "image/png")}
+    img_upload_res = await comfy.post("upload/image", files=files)
 
-    filename1 = str(time.time()) + ".png"
-    mask_path = "../ui/public/" + filename1
-    mask_preview.save(mask_path)
+    res = img_upload_res.json()
+    res["mask_filename"] = mask_filename
+    res["mask_url"] = "/sam/preview/" + mask_filename
+    content = json.dumps(res).encode()
+    RESULTS.put(key, content)
+    # not from MASK_PREVIEWS, a preview larger than it is never kept
+    return detect_response(key, content, preview_bytes, inline)
+
+
+@app.get("/sam/preview/{mask_filename}")
+def mask_preview(mask_filename: str):
+    preview = MASK_PREVIEWS.get(mask_filename)
+    if preview is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Mask preview not found or expired, run the detect again",
+        )
+    # the name is a content address, the preview never changes
+    return Response(
+        preview,
+        media_type="image/png",
+        headers={"Cache-Control": "max-age=1800, immutable"},
+    )
 
-    # mask_preview_base64 = base64.b64encode(mask_preview.tobytes())
-    original_image.putalpha(mask_image)
-    original_image.save("temp.png")
-    original_image = open("temp.png", "rb")
-    files = {"image": original_image}
-    img_upload_res = requests.post(img_upload_uri, files=files)
 
-    res = img_upload_res.json()
-    res["mask_filename"] = filename1
-    return res
+def job_result(job):
+    if job.status == "invalid":
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Workflow failed to run",
+        )
+    if job.status == "failed":
+        raise HTTPException(
+            status_code=status.HTTP_502_BAD_GATEWAY,
+            detail=f"Workflow failed: {job.error}",
+        )
+    if job.status != "done":
+        return JSONResponse(jobs.info(job), status_code=status.HTTP_202_ACCEPTED)
+    return Response(job.image, media_type=job.media_type, headers={"X-Job-Id": job.id})
 
 
 @app.post("/output")
-def get_output(workflow_json: dict, image_path: str):
-    prompt_uri = COMFY_URI + "prompt"
-    COMFY_OUTPUT_LOCATION = "/Users/vishal/Desktop/hack/ComfyUI/output"
-
+async def get_output(
+    workflow_json: dict,
+    image_path: str,
+    request: Request,
+    wait: bool = True,
+    priority: int = 0,
+    user: str = None,
+):
     # print(workflow_json)
     workflow_json["2"]["inputs"]["image"] = image_path
-    workflow = {"prompt": workflow_json}
-    prompt_res = requests.post(prompt_uri, json=workflow)
+    try:
+        # users take turns in the queue, lower priorities go first
+        job = jobs.schedule(workflow_json, user or request.client.host, priority)
+    except QueueFull:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many workflows queued, try again shortly",
+            headers={"Retry-After": "5"},
+        )
+    print(f"Workflow scheduled as {job.id}")
+    if not wait:
+        return job_result(job)
 
-    if prompt_res.status_code != 200:
+    try:
+        await jobs.wait(job, COMFY_JOB_TIMEOUT)
+    except asyncio.TimeoutError:
         raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Workflow failed to run",
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail=f"Workflow still running, poll /output/{job.id}",
+            headers={"X-Job-Id": job.id},
         )
-    print("Workflow ran successfully!")
-    time.sleep(3)
+    return job_result(job)
 
-    files = os.listdir(COMFY_OUTPUT_LOCATION)
-    files = [f for f in files if f.endswith(".png")]
-    files.sort(key=lambda x: os.path.getmtime(os.path.join(COMFY_OUTPUT_LOCATION, x)))
-    latest_file = files[-1]
 
-    with open(os.path.join(COMFY_OUTPUT_LOCATION, latest_file), "rb") as f:
-        return Response(f.read(), media_type="image/png")
+@app.get("/jobs")
+def job_stats():
+    return jobs.stats()
+
+
+@app.get("/output/{job_id}")
+def output_status(job_id: str):
+    """The job's image once it is done, its status with a 202 until then."""
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Job not found or expired",
+        )
+    return job_result(job)
 
 
 @app.post("/blend/upload")
 def upload_blend(src_image: UploadFile):
     try:
         img = Image.open(BytesIO(src_image.file.read()))
-        img.save("tempsdfasdfasdf.png")
+        source_alpha = np.array(img.convert("RGBA"))
     except Exception as e:
         return {"success": "false", "message": str(e)}
-    # img = open("temp.png", "rb")
-    # files = {"image": img}
-    return {"success": "true", "message": "Image uploaded successfully"}
+    # blends only read the source, keep them from changing the stored copy
+    source_alpha.flags.writeable = False
+    token = secrets.token_urlsafe(16)
+    BLEND_SESSIONS.put(token, source_alpha)
+    return {
+        "success": "true",
+        "message": "Image uploaded successfully",
+        "token": token,
+    }
 
 
 @app.post("/blend")
-def poisson_blend(target_image: UploadFile):
-    source_alpha = Image.open("tempsdfasdfasdf.png").convert("RGBA")
+def poisson_blend(
+    target_image: UploadFile,
+    token: str,
+    mode: str = "masked",
+    solver: str = "direct",
+    tol: float = 1e-5,
+):
+    if mode not in BLEND_MODES:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"mode must be one of {', '.join(BLEND_MODES)}",
+        )
+    if solver not in SOLVERS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"solver must be one of {', '.join(SOLVERS)}",
+        )
+    source_alpha = BLEND_SESSIONS.get(token)
+    if source_alpha is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Blend session not found or expired, upload the source again",
+        )
+    height, width = source_alpha.shape[:2]
     target_image = Image.open(BytesIO(target_image.file.read())).convert("RGB")
-    target_image = target_image.resize(source_alpha.size)
-    source_image = source_alpha.convert("RGB")
-    source_mask = source_alpha.split()[3]
+    target_image = target_image.resize((width, height))
     # convert the image to numpy array like cv2 reads it
-    source_image = np.array(source_image)
+    source_image = np.ascontiguousarray(source_alpha[..., :3])
     target_image = np.array(target_image)
-    source_mask = np.array(source_mask)
+    source_mask = source_alpha[..., 3].copy()
 
     # print(source_image.shape, target_image.shape, source_mask.shape)
-    poisson_blend_image = poisson_edit(source_image, target_image, source_mask, (0, 0))
+    # same token, same worker, so re-blends reuse its cached factorization
+    poisson_blend_image = run_in_worker(
+        poisson_edit,
+        [source_image, target_image, source_mask],
+        target_image.shape,
+        affinity=token,
+        offset=(0, 0),
+        mode=mode,
+        solver=solver,
+        tol=tol,
+    )
     output_binary = io.BytesIO()
 
     is_success, buffer = cv2.imencode(".png", poisson_blend_image)
@@ -242,19 +371,98 @@ def poisson_blend(target_image: UploadFile):
     return StreamingResponse(output_binary, media_type="image/png")
 
 
-@app.post("/removebackground")
-def remove_background(seg_image: UploadFile):
+@app.get("/blend/cache")
+def blend_cache_stats():
+    # the solver caches live in the worker processes, sum them up. Their
+    # budgets are split between the workers, so max_bytes adds up to
+    # LAPLACIAN_CACHE_BYTES and FACTOR_CACHE_BYTES whatever their number
+    worker_stats = workers.broadcast(cache_stats)
+    return {
+        "workers": len(worker_stats),
+        "laplacian": merge_stats([s["laplacian"] for s in worker_stats]),
+        "factorization": merge_stats([s["factorization"] for s in worker_stats]),
+        "sessions": BLEND_SESSIONS.stats(),
+    }
 
-    img = Image.open(BytesIO(seg_image.file.read()))
-    img.save("asset.png")
 
-    with open("asset.png", "rb") as i:
-        input = i.read()
-        output = remove(input)
+@app.get("/results/cache")
+def result_cache_stats():
+    return RESULTS.stats()
 
-    output_binary = io.BytesIO(output)
 
-    return StreamingResponse(output_binary, media_type="image/png")
+@app.get("/workers")
+def worker_stats():
+    return workers.stats()
+
+
+@app.post("/removebackground")
+def remove_background(seg_image: UploadFile, request: Request):
+    data = seg_image.file.read()
+    key = content_key(data, op="removebackground", model=background.REMBG_MODEL)
+    if not_modified(request, key):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED)
+
+    content = RESULTS.get(key)
+    if content is None:
+        image = np.array(Image.open(BytesIO(data)).convert("RGB"))
+        output = run_in_worker(
+            background.remove_background, [image], image.shape[:2] + (4,)
+        )
+        content = encode_png(output)
+        RESULTS.put(key, content)
+
+    return result_response(key, content, "image/png")
+
+
+@app.post("/removebackground/batch")
+def remove_background_batch(seg_images: List[UploadFile]):
+    keys = []
+    results = {}
+    images = {}
+    for seg_image in seg_images:
+        data = seg_image.file.read()
+        key = content_key(data, op="removebackground", model=background.REMBG_MODEL)
+        keys.append(key)
+        content = RESULTS.get(key)
+        if content is not None:
+            results[key] = content
+        elif key not in images:
+            images[key] = np.array(Image.open(BytesIO(data)).convert("RGB"))
+
+    def run_chunk(chunk):
+        shapes = background.batch_shapes(chunk)
+        output = run_in_worker(
+            background.remove_background_batch,
+            chunk,
+            (sum(int(np.prod(shape)) for shape in shapes),),
+        )
+        offsets = np.cumsum([0] + [int(np.prod(shape)) for shape in shapes])
+        return [
+            output[start:end].reshape(shape)
+            for start, end, shape in zip(offsets, offsets[1:], shapes)
+        ]
+
+    if images:
+        # one job per worker, each runs its share back to back on a warm session
+        missing = list(images)
+        n_chunks = min(len(missing), workers.workers)
+        bounds = np.linspace(0, len(missing), n_chunks + 1).astype(int)
+        chunks = [
+            [images[key] for key in missing[start:end]]
+            for start, end in zip(bounds, bounds[1:])
+        ]
+        with ThreadPoolExecutor(n_chunks) as pool:
+            outputs = [
+                image for chunk in pool.map(run_chunk, chunks) for image in chunk
+            ]
+        for key, output in zip(missing, outputs):
+            results[key] = encode_png(output)
+            RESULTS.put(key, results[key])
+
+    return {
+        "images": [base64.b64encode(results[key]).decode("utf-8") for key in keys],
+        "etags": [f'"{key}"' for key in keys],
+    }
 
 
 if __name__ == "__main__":
@@ -0,0 +1,75 @@
+import io
+
+import cv2
+import numpy as np
+from PIL import Image, ImageEnhance
+
+# brightness of the area outside the mask in the preview
+DIM = 0.3
+# ImageEnhance.Brightness truncates a single precision product, same here
+_DIM_LUT = (np.arange(256, dtype=np.float32) * np.float32(DIM)).astype(np.uint8)
+
+
+def encode_png(image):
+    output_binary = io.BytesIO()
+    image.save(output_binary, "PNG")
+    return output_binary.getvalue()
+
+
+def imencode_png(array):
+    # a lot faster than PIL, at OpenCV's default, fastest compression level
+    return cv2.imencode(".png", array)[1].tobytes()
+
+
+def composite(original, mask):
+    """Mask preview and masked original of a 3 or 4 channel image.
+
+    The preview keeps the pixels where mask > 128 and darkens the others,
+    the masked original gets 255 - mask as alpha, any alpha the original
+    has is kept in the preview. Pixel for pixel the same as composite_pil,
+    in whichever channel order the original comes.
+    """
+    preview = cv2.LUT(original, _DIM_LUT)
+    if original.shape[2] == 4:
+        cv2.insertChannel(cv2.extractChannel(original, 3), preview, 3)
+    _, keep = cv2.threshold(mask, 128, 255, cv2.THRESH_BINARY)
+    cv2.copyTo(original, keep, preview)
+
+    if original.shape[2] == 4:
+        masked = original.copy()
+    else:
+        masked = cv2.cvtColor(original, cv2.COLOR_BGR2BGRA)
+    cv2.insertChannel(cv2.bitwise_not(mask), masked, 3)
+    return preview, masked
+
+
+def composite_pil(original_image, mask_image_r):
+    """The PIL version of composite, works for any image mode."""
+    mask_image = mask_image_r.point(lambda p: 255 - p)
+
+    mask_image_rgb = mask_image_r.point(lambda p: p > 128 and 255)
+    dull_image = ImageEnhance.Brightness(original_image).enhance(DIM)
+    mask_preview = Image.composite(original_image, dull_image, mask_image_rgb)
+
+    original_image = original_image.copy()
+    original_image.putalpha(mask_image)
+    return mask_preview, original_image
+
+
+def compose_detect(image_bytes, fetch_img_bytes):
+    """Mask preview and the masked original to upload, both PNG encoded,
+    from the detect mask and the original image."""
+    mask_image_r = Image.open(io.BytesIO(image_bytes)).convert("L")
+    # BGR(A) as decoded, composite doesn't care and imencode expects it
+    original = cv2.imdecode(
+        np.frombuffer(fetch_img_bytes, dtype=np.uint8), cv2.IMREAD_UNCHANGED
+    )
+
+    if original is None or original.dtype != np.uint8 or original.ndim != 3:
+        # grayscale and 16 bit originals keep their mode through PIL
+        original_image = Image.open(io.BytesIO(fetch_img_bytes))
+        mask_preview, masked = composite_pil(original_image, mask_image_r)
+        return encode_png(mask_preview), encode_png(masked)
+
+    mask_preview, masked = composite(original, np.asarray(mask_image_r))
+    return imencode_png(mask_preview), imencode_png(masked)
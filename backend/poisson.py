@@ -0,0 +1,379 @@
+import hashlib
+import os
+
+import cv2
+import numpy as np
+import scipy.sparse
+from scipy.sparse.linalg import cg, splu
+
+from cache import LRUCache
+from workers import WORKER_PROCESSES
+
+
+def _sparse_nbytes(mat):
+    return mat.data.nbytes + mat.indices.nbytes + mat.indptr.nbytes
+
+
+def _factor_nbytes(factorization):
+    factor, boundary = factorization
+    # SuperLU keeps one float64 value and one int32 index per nonzero
+    nbytes = factor.nnz * 12 + factor.perm_c.nbytes + factor.perm_r.nbytes
+    if boundary is not None:
+        nbytes += _sparse_nbytes(boundary)
+    return nbytes
+
+
+# laplacians keyed by (height, width) and factorized systems keyed by the
+# mask, so re-blending the same cutout only pays for the triangular solves.
+# Every worker process has its own caches, the budgets are for all of them
+# and split evenly
+LAPLACIAN_CACHE_BYTES = int(os.environ.get("LAPLACIAN_CACHE_BYTES", 256 * 1024**2))
+FACTOR_CACHE_BYTES = int(os.environ.get("FACTOR_CACHE_BYTES", 1024**3))
+LAPLACIAN_CACHE = LRUCache(LAPLACIAN_CACHE_BYTES // WORKER_PROCESSES, _sparse_nbytes)
+FACTOR_CACHE = LRUCache(FACTOR_CACHE_BYTES // WORKER_PROCESSES, _factor_nbytes)
+
+
+def cache_stats():
+    return {
+        "laplacian": LAPLACIAN_CACHE.stats(),
+        "factorization": FACTOR_CACHE.stats(),
+    }
+
+
+def laplacian_matrix(n, m):
+    """Generate the Poisson matrix for an n x m grid in CSR form.
+
+    Refer to:
+    https://en.wikipedia.org/wiki/Discrete_Poisson_equation
+
+    Note: it's the transpose of the wiki's matrix. The result is cached on
+    (n, m), so callers must not modify it in place.
+    """
+    return LAPLACIAN_CACHE.get_or_create((n, m), lambda: _laplacian_matrix(n, m))
+
+
+def _laplacian_matrix(n, m):
+    idx = np.arange(n * m).reshape(n, m)
+    horizontal = (idx[:, :-1].ravel(), idx[:, 1:].ravel())
+    vertical = (idx[:-1, :].ravel(), idx[1:, :].ravel())
+
+    rows = np.concatenate(
+        (idx.ravel(), horizontal[0], horizontal[1], vertical[0], vertical[1])
+    )
+    cols = np.concatenate(
+        (idx.ravel(), horizontal[1], horizontal[0], vertical[1], vertical[0])
+    )
+    data = np.full(rows.shape, -1.0)
+    data[: n * m] = 4
+
+    return scipy.sparse.csr_matrix((data, (rows, cols)), shape=(n * m, n * m))
+
+
+BLEND_MODES = ("masked", "full")
+SOLVERS = ("direct", "cg", "multigrid")
+
+
+def poisson_matrix(mask):
+    """Assemble the poisson system for a binary mask in CSC form.
+
+    Pixels outside the mask get an identity row so they keep the target
+    value, the rest keep the laplacian row.
+    """
+    y_range, x_range = mask.shape
+    laplacian = laplacian_matrix(y_range, x_range).tocoo()
+
+    identity = np.flatnonzero(mask == 0)
+
+    keep = np.ones(y_range * x_range, dtype=bool)
+    keep[identity] = False
+    keep = keep[laplacian.row]
+
+    rows = np.concatenate((laplacian.row[keep], identity))
+    cols = np.concatenate((laplacian.col[keep], identity))
+    data = np.concatenate((laplacian.data[keep], np.ones(identity.size)))
+
+    return scipy.sparse.csc_matrix((data, (rows, cols)), shape=laplacian.shape)
+
+
+def mask_bounds(mask):
+    """Bounding box of the mask grown by one pixel, clipped to the image."""
+    ys, xs = np.nonzero(mask)
+    y_min, x_min = max(ys.min() - 1, 0), max(xs.min() - 1, 0)
+    y_max = min(ys.max() + 2, mask.shape[0])
+    x_max = min(xs.max() + 2, mask.shape[1])
+    return y_min, y_max, x_min, x_max
+
+
+def _stencil(u):
+    """Apply the 5-point laplacian to a grid, zero outside of it."""
+    v = 4 * u
+    v[1:] -= u[:-1]
+    v[:-1] -= u[1:]
+    v[:, 1:] -= u[:, :-1]
+    v[:, :-1] -= u[:, 1:]
+    return v
+
+
+def _apply(u, inside):
+    """Matrix-free product with the poisson system restricted to a mask."""
+    v = _stencil(u)
+    v *= inside
+    return v
+
+
+def _restrict(f):
+    """Cell-centered full weighting onto a grid half the size (rounded up)."""
+    for axis in (0, 1):
+        f = np.moveaxis(f, axis, 0)
+        if len(f) % 2:
+            f = np.concatenate((f, np.zeros_like(f[:1])))
+        even, odd = f[0::2], f[1::2]
+        c = even + odd
+        c *= 0.75
+        c[1:] += 0.25 * odd[:-1]
+        c[:-1] += 0.25 * even[1:]
+        c /= 2
+        f = np.moveaxis(c, 0, axis)
+    return f
+
+
+def _prolong(c, shape):
+    """Bilinear interpolation back onto the fine grid, the transpose of
+    _restrict up to a factor of 4."""
+    for axis in (0, 1):
+        c = np.moveaxis(c, axis, 0)
+        f = np.empty((2 * len(c),) + c.shape[1:], dtype=c.dtype)
+        f[0::2] = 0.75 * c
+        f[1::2] = f[0::2]
+        f[2::2] += 0.25 * c[:-1]
+        f[1:-2:2] += 0.25 * c[1:]
+        c = np.moveaxis(f[: shape[axis]], 0, axis)
+    return c
+
+
+class Multigrid:
+    """Geometric multigrid V-cycle for the poisson system on a masked grid.
+
+    Each level halves the grid, a coarse cell is inside the mask if at
+    least half of the fine cells it covers are. The coarsest level is
+    solved directly. The V-cycle only preconditions the outer conjugate
+    gradient, so it runs in float32 to halve its memory traffic.
+    """
+
+    def __init__(self, inside, coarsest=32, smooth=2, omega=0.8):
+        self.levels = [inside]
+        while max(self.levels[-1].shape) > coarsest:
+            coarse = _restrict(self.levels[-1].astype(np.float32)) >= 0.5
+            if not coarse.any():
+                # thin masks vanish when coarsened, solve what is left
+                break
+            self.levels.append(coarse)
+        self.smooth = smooth
+        self.omega = omega
+
+        coarse = self.levels[-1].ravel()
+        laplacian = laplacian_matrix(*self.levels[-1].shape)
+        self.factor = splu(laplacian[coarse][:, coarse].tocsc())
+
+    def _smooth(self, e, r, inside):
+        # damped jacobi, the diagonal is 4 everywhere
+        for _ in range(self.smooth):
+            v = _apply(e, inside)
+            np.subtract(r, v, out=v)
+            v *= self.omega / 4
+            e += v
+
+    def v_cycle(self, r, level=0):
+        inside = self.levels[level]
+        r = r.astype(np.float32, copy=False)
+        e = np.zeros_like(r)
+        if level == len(self.levels) - 1:
+            e[inside] = self.factor.solve(r[inside].astype(np.float64))
+            return e
+
+        self._smooth(e, r, inside)
+
+        coarse_r = _apply(e, inside)
+        np.subtract(r, coarse_r, out=coarse_r)
+        coarse_r = _restrict(coarse_r)
+        coarse_r *= 4 * self.levels[level + 1]
+        correction = _prolong(self.v_cycle(coarse_r, level + 1), r.shape)
+        correction *= inside
+        e += correction
+
+        self._smooth(e, r, inside)
+        return e
+
+    def solve(self, b, x, tol, maxiter=200):
+        """Conjugate gradient preconditioned with one V-cycle per step,
+        starting from x."""
+        inside = self.levels[0]
+        r = b - _apply(x, inside)
+        z = self.v_cycle(r)
+        p = z.astype(np.float64)
+        rz = np.vdot(r, z)
+        b_norm = np.linalg.norm(b)
+        for _ in range(maxiter):
+            if np.linalg.norm(r) <= tol * b_norm:
+                break
+            Ap = _apply(p, inside)
+            alpha = rz / np.vdot(p, Ap)
+            x += alpha * p
+            r -= alpha * Ap
+            z = self.v_cycle(r)
+            rz_next = np.vdot(r, z)
+            p *= rz_next / rz
+            p += z
+            rz = rz_next
+        return x
+
+
+def masked_system(inside):
+    """The poisson system over the pixels inside the mask, and the columns
+    coupling them to the target pixels around the mask."""
+    inside_flat = inside.ravel()
+    rows = laplacian_matrix(*inside.shape)[inside_flat]
+    return rows[:, inside_flat].tocsc(), rows[:, ~inside_flat]
+
+
+def factorize(inside, full=False):
+    """Factorize the poisson system for a mask, cached on the mask.
+
+    Returns the factorization and, unless full, the boundary columns from
+    masked_system.
+    """
+    digest = hashlib.blake2b(np.packbits(inside)).hexdigest()
+
+    def create():
+        if full:
+            return splu(poisson_matrix(inside)), None
+        mat_A, boundary = masked_system(inside)
+        return splu(mat_A), boundary
+
+    return FACTOR_CACHE.get_or_create((full, inside.shape, digest), create)
+
+
+def sparse_solve(source, target, inside, solver="direct", tol=1e-5, full=False):
+    """Solve for the pixels inside the mask with an assembled sparse system.
+
+    With full=True every pixel is an unknown and the ones outside the mask
+    get identity rows, otherwise only the pixels inside the mask are
+    unknowns and the target pixels around them are moved to the right-hand
+    side. Returns an (n, channels) array for the n pixels inside the mask.
+    """
+    laplacian = laplacian_matrix(*inside.shape)
+    inside_flat = inside.ravel()
+    channels = source.shape[2]
+    source_flat = source.reshape(-1, channels)
+    target_flat = target.reshape(-1, channels)
+
+    # concat = source_flat*mask_flat + target_flat*(1-mask_flat)
+
+    # inside the mask:
+    # \Delta f = div v = \Delta g
+    alpha = 1
+    mat_b = laplacian.dot(source_flat) * alpha
+
+    if solver == "direct":
+        factor, boundary = factorize(inside, full)
+    else:
+        mat_A, boundary = masked_system(inside)
+
+    if full:
+        # set the region outside the mask to identity
+        # outside the mask:
+        # f = t
+        mat_b[~inside_flat] = target_flat[~inside_flat]
+        return factor.solve(mat_b)[inside_flat]
+
+    mat_b = mat_b[inside_flat] - boundary.dot(target_flat[~inside_flat])
+
+    if solver == "direct":
+        return factor.solve(mat_b)
+
+    # jacobi preconditioner, warm start from target
+    precond = scipy.sparse.diags(1 / mat_A.diagonal())
+    x = target_flat[inside_flat].astype(np.float64)
+    for channel in range(channels):
+        x[:, channel], _ = cg(
+            mat_A, mat_b[:, channel], x0=x[:, channel], rtol=tol, M=precond
+        )
+    return x
+
+
+def multigrid_solve(source, target, inside, tol=1e-5):
+    """Solve for the pixels inside the mask matrix-free with Multigrid.
+
+    Returns an (n, channels) array for the n pixels inside the mask.
+    """
+    multigrid = Multigrid(inside)
+    channels = source.shape[2]
+    x = np.empty((np.count_nonzero(inside), channels))
+    for channel in range(channels):
+        s = source[..., channel].astype(np.float64)
+        t = target[..., channel].astype(np.float64)
+
+        # \Delta g inside, minus the known target pixels around the mask
+        b = _stencil(s) - _stencil(np.where(inside, 0, t))
+        b *= inside
+
+        # warm start from the target pixels
+        x[:, channel] = multigrid.solve(b, t * inside, tol)[inside]
+    return x
+
+
+def poisson_edit(
+    source, target, mask, offset, mode="masked", solver="direct", tol=1e-5
+):
+    """The poisson blending function.
+
+    Refer to:
+    Perez et. al., "Poisson Image Editing", 2003.
+
+    mode "full" solves for every pixel of the target, "masked" crops to the
+    mask and solves only for the pixels inside it, with the surrounding
+    target pixels as boundary values. Both give the same result.
+
+    solver picks how the system is solved: "direct" factorizes it, "cg" and
+    "multigrid" iterate from the target pixels until the relative residual
+    drops below tol, which keeps memory bounded on large images.
+    """
+    if mode not in BLEND_MODES:
+        raise ValueError(f"unknown blend mode {mode!r}")
+    if solver not in SOLVERS:
+        raise ValueError(f"unknown solver {solver!r}")
+
+    # Assume:
+    # target is not smaller than source.
+    # shape of mask is same as shape of target.
+    y_max, x_max = target.shape[:-1]
+    y_min, x_min = 0, 0
+
+    M = np.float32([[1, 0, offset[0]], [0, 1, offset[1]]])
+    source = cv2.warpAffine(source, M, (x_max, y_max))
+
+    if not mask.any():
+        return target
+    if mode == "masked":
+        y_min, y_max, x_min, x_max = mask_bounds(mask)
+
+    mask = mask[y_min:y_max, x_min:x_max]
+    mask[mask != 0] = 1
+    # mask = cv2.threshold(mask, 127, 1, cv2.THRESH_BINARY)
+    inside = mask != 0
+
+    source = source[y_min:y_max, x_min:x_max]
+    target_crop = target[y_min:y_max, x_min:x_max]
+
+    if solver == "multigrid":
+        x = multigrid_solve(source, target_crop, inside, tol)
+    else:
+        full = mode == "full" and solver == "direct"
+        x = sparse_solve(source, target_crop, inside, solver, tol, full)
+
+    # round rather than truncate, 56.9999 should come back as 57
+    x = np.clip(np.rint(x), 0, 255).astype("uint8")
+    # x = cv2.normalize(x, alpha=0, beta=255, norm_type=cv2.NORM_MINMAX)
+    target_crop[inside] = x
+
+    return target
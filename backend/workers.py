@@ -0,0 +1,226 @@
+import os
+import threading
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+# worker tier for the CPU heavy image operations, see WorkerPool. Every
+# worker loads its own rembg session, so by default there's at most 4
+WORKER_PROCESSES = int(os.environ.get("WORKER_PROCESSES", min(os.cpu_count() or 1, 4)))
+WORKER_QUEUE_DEPTH = int(os.environ.get("WORKER_QUEUE_DEPTH", 2 * WORKER_PROCESSES))
+WORKER_TIMEOUT = float(os.environ.get("WORKER_TIMEOUT", 120))
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobTimeout(Exception):
+    pass
+
+
+class WorkerCrashed(Exception):
+    pass
+
+
+def _views(segments, specs):
+    return [
+        np.ndarray(shape, dtype, buffer=shm.buf)
+        for shm, (_, shape, dtype) in zip(segments, specs)
+    ]
+
+
+def _close(segments):
+    for shm in segments:
+        try:
+            shm.close()
+        except BufferError:
+            # a failed job can still hold views, the mapping goes with them
+            pass
+
+
+def _run_shared(fn, specs, kwargs):
+    """Worker side of WorkerPool.run, the arrays never go through pickle.
+
+    specs describes the inputs followed by the output.
+    """
+    segments = [shared_memory.SharedMemory(name=name) for name, _, _ in specs]
+    try:
+        *inputs, out = _views(segments, specs)
+        out[...] = fn(*inputs, **kwargs)
+        del inputs, out
+    finally:
+        _close(segments)
+
+
+def _warm_up():
+    return os.getpid()
+
+
+class WorkerPool:
+    """Process pool for the CPU heavy image operations.
+
+    A job takes numpy arrays and produces one array of a known shape. The
+    inputs and the output live in shared memory, only their names go
+    through the pool. At most workers + queue_depth jobs are accepted at
+    once, further ones raise QueueFull so the caller can answer with a 503
+    instead of piling up. A job running longer than timeout raises
+    JobTimeout, it keeps its slot until the worker actually finishes.
+
+    Every worker is its own single process executor. Jobs go to the least
+    busy one, or always to the same one for a given affinity key so that
+    per process caches keep getting hits. A worker process that dies, ie.
+    killed for running out of memory, is replaced by a new one, the job it
+    was running raises WorkerCrashed.
+    """
+
+    def __init__(
+        self,
+        workers=WORKER_PROCESSES,
+        queue_depth=WORKER_QUEUE_DEPTH,
+        timeout=WORKER_TIMEOUT,
+        initializer=None,
+    ):
+        self.workers = workers
+        self.capacity = workers + queue_depth
+        self.timeout = timeout
+        self.rejected = 0
+        self.timed_out = 0
+        self.restarts = 0
+        self._initializer = initializer
+        # workers attaching to a segment register it with the resource tracker,
+        # start it before they fork so they share ours and don't each clean up
+        # segments we already unlinked
+        resource_tracker.ensure_running()
+        self._executors = [
+            ProcessPoolExecutor(1, initializer=initializer) for _ in range(workers)
+        ]
+        self._load = [0] * workers
+        self._slots = threading.BoundedSemaphore(self.capacity)
+        self._lock = threading.Lock()
+
+    def _replace(self, worker, broken):
+        """Replaces the broken executor of worker with a new process, unless
+        another job already did, and returns the new executor."""
+        with self._lock:
+            executor = self._executors[worker]
+            if executor is broken:
+                executor = ProcessPoolExecutor(1, initializer=self._initializer)
+                self._executors[worker] = executor
+                self.restarts += 1
+        broken.shutdown(wait=False)
+        return executor
+
+    def _submit(self, worker, fn, *args):
+        """Submits to worker, on a new process if its own died while idle.
+        Returns the executor with the future."""
+        executor = self._executors[worker]
+        try:
+            return executor, executor.submit(fn, *args)
+        except BrokenProcessPool:
+            executor = self._replace(worker, executor)
+            return executor, executor.submit(fn, *args)
+
+    def broadcast(self, fn, *args):
+        """Call fn(*args) once on every worker and return the results, for
+        per process state such as caches."""
+        submitted = [self._submit(worker, fn, *args) for worker in range(self.workers)]
+        results = []
+        for worker, (executor, future) in enumerate(submitted):
+            try:
+                results.append(future.result(timeout=self.timeout))
+            except BrokenProcessPool:
+                # died since, ask its replacement
+                executor = self._replace(worker, executor)
+                future = executor.submit(fn, *args)
+                results.append(future.result(timeout=self.timeout))
+        return results
+
+    def warm_up(self):
+        """Start every worker process now rather than on the first request."""
+        return self.broadcast(_warm_up)
+
+    def run(
+        self, fn, inputs, out_shape, out_dtype=np.uint8, affinity=None, **kwargs
+    ):
+        """Run fn(*inputs, **kwargs) on a worker and return its result.
+
+        fn has to be importable by the workers, ie. a module level function.
+        """
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise QueueFull()
+
+        shapes = [(array.shape, array.dtype) for array in inputs]
+        shapes.append((tuple(out_shape), np.dtype(out_dtype)))
+        segments = []
+
+        with self._lock:
+            if affinity is None:
+                worker = min(range(self.workers), key=self._load.__getitem__)
+            else:
+                worker = zlib.crc32(str(affinity).encode()) % self.workers
+            self._load[worker] += 1
+
+        def release(_=None):
+            _close(segments)
+            for shm in segments:
+                shm.unlink()
+            with self._lock:
+                self._load[worker] -= 1
+            self._slots.release()
+
+        try:
+            for shape, dtype in shapes:
+                size = max(int(np.prod(shape)) * dtype.itemsize, 1)
+                segments.append(shared_memory.SharedMemory(create=True, size=size))
+            specs = [
+                (shm.name, shape, dtype.str)
+                for shm, (shape, dtype) in zip(segments, shapes)
+            ]
+            *views, out = _views(segments, specs)
+            for view, array in zip(views, inputs):
+                view[...] = array
+            del views, out
+            executor, future = self._submit(worker, _run_shared, fn, specs, kwargs)
+        except BaseException:
+            release()
+            raise
+
+        try:
+            future.result(timeout=self.timeout)
+            out = _views(segments[-1:], specs[-1:])[0]
+            result = out.copy()
+            del out
+            return result
+        except FutureTimeoutError:
+            with self._lock:
+                self.timed_out += 1
+            raise JobTimeout()
+        except BrokenProcessPool:
+            # the process died running the job, later jobs get a new one
+            self._replace(worker, executor)
+            raise WorkerCrashed()
+        finally:
+            # frees the segments and the slot once the worker is done with them
+            future.add_done_callback(release)
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "capacity": self.capacity,
+            "pending": sum(self._load),
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "restarts": self.restarts,
+            "timeout": self.timeout,
+        }
+
+    def shutdown(self):
+        for executor in self._executors:
+            executor.shutdown(wait=False, cancel_futures=True)
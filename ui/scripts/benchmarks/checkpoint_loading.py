@@ -0,0 +1,97 @@
+"""Load time and memory of server processes reading or mapping SAM.
+
+Starts --processes processes that each load the model, read into memory as
+build_sam does or memory-mapped with build_sam_mmap, then measures them
+while they're all alive. private is the memory only that process uses, pss
+splits the shared pages between the processes that map them, so the sum of
+pss is what they take together. With --encode every process encodes an
+image first, one at a time, to check the weights stay shared after use.
+Linux only. Run from the ui/scripts directory:
+    python -m benchmarks.checkpoint_loading --model_path model/sam_vit_b_01ec64.pth
+"""
+import multiprocessing
+import statistics
+import time
+
+import click
+import numpy as np
+from segment_anything import sam_model_registry
+
+from models import build_sam_mmap
+from predictors import EncoderBatcher
+
+
+def memory_mb():
+    """Rss, Pss and private memory of this process from smaps_rollup."""
+    fields = {}
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                fields[parts[0].rstrip(":")] = int(parts[1]) / 1024
+    private = fields["Private_Clean"] + fields["Private_Dirty"]
+    return {"rss": fields["Rss"], "pss": fields["Pss"], "private": private}
+
+
+def worker(mode, model, model_path, encode, encode_lock, loaded, results):
+    start = time.perf_counter()
+    if mode == "mmap":
+        sam = build_sam_mmap(model, model_path)
+    else:
+        sam = sam_model_registry[model](checkpoint=model_path)
+    load_seconds = time.perf_counter() - start
+    if encode:
+        image = np.random.default_rng(0).integers(0, 256, (256, 256, 3), np.uint8)
+        with encode_lock:
+            encoder = EncoderBatcher(sam, 1, 0)
+            encoder.encode(image)
+            encoder.close()
+    # measured once every process has loaded, so the shared pages are split
+    loaded.wait()
+    results.put({"load": load_seconds, **memory_mb()})
+    loaded.wait()
+
+
+def run(mode, model, model_path, processes, encode):
+    context = multiprocessing.get_context("spawn")
+    encode_lock = context.Lock()
+    loaded = context.Barrier(processes)
+    results = context.Queue()
+    workers = [
+        context.Process(
+            target=worker,
+            args=(mode, model, model_path, encode, encode_lock, loaded, results),
+        )
+        for _ in range(processes)
+    ]
+    for process in workers:
+        process.start()
+    stats = [results.get() for _ in workers]
+    for process in workers:
+        process.join()
+    return stats
+
+
+@click.command()
+@click.option(
+    "--model",
+    default="vit_b",
+    type=click.Choice(["vit_b", "vit_l", "vit_h"]),
+)
+@click.option("--model_path", required=True)
+@click.option("--processes", default=2)
+@click.option("--encode", is_flag=True, help="encode an image in every process")
+def main(model, model_path, processes, encode):
+    for mode in ("read", "mmap"):
+        stats = run(mode, model, model_path, processes, encode)
+        print(
+            f"{mode:5} {processes} processes  "
+            f"load {statistics.median(s['load'] for s in stats):6.2f}s  "
+            f"rss {statistics.fmean(s['rss'] for s in stats):6.0f}MB  "
+            f"private {statistics.fmean(s['private'] for s in stats):6.0f}MB  "
+            f"pss total {sum(s['pss'] for s in stats):6.0f}MB"
+        )
+
+
+if __name__ == "__main__":
+    main()
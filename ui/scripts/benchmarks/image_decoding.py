@@ -0,0 +1,86 @@
+"""Decode time, memory and mask size of full and reduced uploads.
+
+Decodes a photo sized image as the prompt endpoints did, in full, and as
+they do now, down to --max_side, both times followed by the resize SAM
+does before the encoder. Reports the time, the peak memory the decode adds
+(Linux only), and the size of the masks sent back at the full and the
+decoded size. Run from the ui/scripts directory:
+    python -m benchmarks.image_decoding --size 3024 4032
+"""
+import io
+import json
+import time
+
+import click
+import numpy as np
+from PIL import Image
+from segment_anything.utils.transforms import ResizeLongestSide
+
+from benchmarks.mask_encoding import make_masks
+from benchmarks.onnx_runtime import reset_peak, rss_mb
+from image_decoding import decode_image, decoded_size, open_image
+from mask_encoding import encode_mask
+
+
+def make_image(height, width, image_format):
+    """A smooth image with some texture, about as compressible as a photo."""
+    rng = np.random.default_rng(0)
+    y, x = np.ogrid[:height, :width]
+    image = np.zeros((height, width, 3), dtype=np.float32)
+    for channel in range(3):
+        fx, fy = rng.uniform(1, 6, 2)
+        image[..., channel] = 127 + 100 * np.sin(fx * x / width * np.pi) * np.cos(
+            fy * y / height * np.pi
+        )
+    image += rng.normal(0, 8, image.shape)
+    buffer = io.BytesIO()
+    Image.fromarray(image.clip(0, 255).astype(np.uint8)).save(buffer, image_format)
+    return buffer.getvalue()
+
+
+def measure(file, max_side, transform, repeat):
+    best = float("inf")
+    peak = 0.0
+    for _ in range(repeat):
+        reset_peak()
+        before = rss_mb()
+        start = time.perf_counter()
+        transform.apply_image(decode_image(open_image(file), max_side))
+        best = min(best, time.perf_counter() - start)
+        peak = max(peak, rss_mb("VmHWM") - before)
+    return best, peak
+
+
+@click.command()
+@click.option("--size", nargs=2, type=int, default=(3024, 4032), help="height width")
+@click.option("--max_side", default=1024)
+@click.option("--repeat", default=3)
+def main(size, max_side, repeat):
+    transform = ResizeLongestSide(1024)
+    for image_format in ("JPEG", "PNG"):
+        file = make_image(*size, image_format)
+        print(f"{image_format} {size[0]}x{size[1]}, {len(file) / 1024**2:.1f} MB")
+        for label, side in (("full", None), (f"to {max_side}", max_side)):
+            seconds, peak = measure(file, side, transform, repeat)
+            print(f"  {label:8}  {seconds * 1000:6.0f} ms  +{peak:5.0f} MB peak")
+
+    print("3 masks of a prompt, rle / text")
+    for label, mask_size in (
+        ("full", size),
+        ("decoded", decoded_size(size, max_side)),
+    ):
+        masks = make_masks(3, *mask_size, noisy=False)
+        nbytes = {
+            mask_format: sum(
+                len(json.dumps(encode_mask(mask, mask_format))) for mask in masks
+            )
+            for mask_format in ("rle", "text")
+        }
+        print(
+            f"  {label:8}  {mask_size[0]}x{mask_size[1]}  "
+            f"{nbytes['rle'] / 1024:6.1f} KB / {nbytes['text'] / 1024:6.1f} KB"
+        )
+
+
+if __name__ == "__main__":
+    main()
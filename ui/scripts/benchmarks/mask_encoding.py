@@ -0,0 +1,75 @@
+"""Response size and encode time of the mask formats.
+
+The masks are blobs with ragged edges, roughly what SAM returns for an
+object, "noisy" ones have speckles all over like a low quality mask. The
+size is that of the JSON the server sends per mask. Run from the ui/scripts
+directory:
+    python -m benchmarks.mask_encoding --size 1500 2250
+"""
+import base64
+import json
+import time
+import zlib
+
+import click
+import numpy as np
+
+from mask_encoding import MASK_FORMATS, encode_mask, rle_counts
+
+
+def make_masks(count, height, width, noisy):
+    rng = np.random.default_rng(0)
+    y, x = np.ogrid[:height, :width]
+    masks = []
+    for _ in range(count):
+        cy, cx = rng.uniform(0.2, 0.8) * height, rng.uniform(0.2, 0.8) * width
+        ry, rx = rng.uniform(0.05, 0.3) * height, rng.uniform(0.05, 0.3) * width
+        angle = np.arctan2(y - cy, x - cx)
+        edge = 1 + 0.1 * np.sin(rng.integers(3, 12) * angle)
+        mask = ((y - cy) / ry) ** 2 + ((x - cx) / rx) ** 2 < edge**2
+        if noisy:
+            mask ^= rng.random((height, width)) < 0.01
+        masks.append(mask)
+    return masks
+
+
+def decode(segmentation, shape):
+    """Checks a mask round trips, text isn't decoded here."""
+    if segmentation["format"] == "rle":
+        # only the counts, their string encoding is pycocotools' own
+        return None
+    data = base64.b64decode(segmentation["data"])
+    if segmentation["zlib"]:
+        data = zlib.decompress(data)
+    bits = np.unpackbits(np.frombuffer(data, dtype=np.uint8))
+    return bits[: shape[0] * shape[1]].reshape(shape).astype(bool)
+
+
+@click.command()
+@click.option("--size", nargs=2, type=int, default=(1024, 1024), help="height width")
+@click.option("--masks", default=20)
+@click.option("--repeat", default=3)
+def main(size, masks, repeat):
+    for noisy in (False, True):
+        samples = make_masks(masks, *size, noisy)
+        counts = sum(len(rle_counts(mask)) for mask in samples) // masks
+        print(f"{'noisy' if noisy else 'smooth'} masks, {counts} runs on average")
+        for mask_format in MASK_FORMATS:
+            best = float("inf")
+            for _ in range(repeat):
+                start = time.perf_counter()
+                encoded = [encode_mask(mask, mask_format) for mask in samples]
+                best = min(best, time.perf_counter() - start)
+            if mask_format != "text":
+                for mask, segmentation in zip(samples, encoded):
+                    decoded = decode(segmentation, mask.shape)
+                    assert decoded is None or (decoded == mask).all()
+            nbytes = sum(len(json.dumps(segmentation)) for segmentation in encoded)
+            print(
+                f"  {mask_format:14} {nbytes / masks / 1024:9.1f} KB/mask  "
+                f"{best / masks * 1000:7.2f} ms/mask"
+            )
+
+
+if __name__ == "__main__":
+    main()
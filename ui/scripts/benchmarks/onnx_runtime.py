@@ -0,0 +1,149 @@
+"""Compare the torch and ONNX Runtime paths of the SAM server.
+
+Encodes the same images with the torch encoder, the exported encoder and
+its int8 quantized version, then decodes the same clicks on each embedding
+with SamPredictor and with OnnxPredictor on the exported decoder. Reports
+latency, the peak memory the encoder adds (Linux only), and the IoU of the
+masks against the torch ones. Without --model_path the weights are random,
+fine for timing, but the int8 IoU only means something with real weights.
+Run from the ui/scripts directory:
+    python -m benchmarks.onnx_runtime --model_path model/sam_vit_b_01ec64.pth
+"""
+import os
+import statistics
+import tempfile
+import time
+
+import click
+import numpy as np
+import torch
+from segment_anything import SamPredictor, sam_model_registry
+
+from onnx_inference import (
+    OnnxEncoderBatcher,
+    OnnxPredictor,
+    inference_session,
+    runtime_models,
+    session_options,
+)
+from predictors import EncoderBatcher, set_state
+
+
+def rss_mb(field="VmRSS"):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) / 1024
+    return float("nan")
+
+
+def reset_peak():
+    # resets VmHWM, the peak resident size, to the current one
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+
+
+def encode_all(encoder, images):
+    states, times, peaks = [], [], []
+    for image in images:
+        reset_peak()
+        before = rss_mb()
+        start = time.perf_counter()
+        states.append(encoder.encode(image))
+        times.append(time.perf_counter() - start)
+        peaks.append(rss_mb("VmHWM") - before)
+    return states, times, max(peaks)
+
+
+def decode_all(predictor, states, clicks):
+    masks, times = [], []
+    for state, image_clicks in zip(states, clicks):
+        set_state(predictor, state)
+        for point in image_clicks:
+            start = time.perf_counter()
+            output = predictor.predict(
+                point_coords=point[None], point_labels=np.array([1])
+            )
+            masks.append(output[0])
+            times.append(time.perf_counter() - start)
+    return masks, times
+
+
+def iou(a, b):
+    union = np.logical_or(a, b).sum()
+    return np.logical_and(a, b).sum() / union if union else 1.0
+
+
+@click.command()
+@click.option(
+    "--model",
+    default="vit_b",
+    type=click.Choice(["vit_b", "vit_l", "vit_h"]),
+)
+@click.option("--model_path", default=None, help="checkpoint, random weights if unset")
+@click.option("--onnx_dir", default=None, help="where the exported models go")
+@click.option("--images", default=2)
+@click.option("--clicks", default=5, help="clicks per image")
+@click.option("--size", nargs=2, type=int, default=(480, 640), help="height width")
+@click.option("--threads", default=0, help="ONNX Runtime threads, 0 for all cores")
+def main(model, model_path, onnx_dir, images, clicks, size, threads):
+    # seeded, so random weights match the models already exported to onnx_dir
+    torch.manual_seed(0)
+    sam = sam_model_registry[model](checkpoint=model_path)
+    sam.eval()
+    onnx_dir = onnx_dir or tempfile.mkdtemp()
+    os.makedirs(onnx_dir, exist_ok=True)
+    base = os.path.join(onnx_dir, os.path.basename(model_path or f"{model}.pth"))
+    int8_path, decoder_path = runtime_models(sam, base, int8=True)
+    encoder_path = int8_path.replace(".int8.onnx", ".onnx")
+    options = session_options(threads)
+
+    rng = np.random.default_rng(0)
+    samples = [
+        rng.integers(0, 256, (*size, 3), dtype=np.uint8) for _ in range(images)
+    ]
+    points = [
+        rng.uniform((0, 0), (size[1], size[0]), (clicks, 2)) for _ in range(images)
+    ]
+
+    # made one at a time, only one encoder session is loaded at once
+    encoders = {
+        "torch": lambda: EncoderBatcher(sam, 1, 0),
+        "ort": lambda: OnnxEncoderBatcher(
+            sam, inference_session(encoder_path, options), 1, 0
+        ),
+        "ort int8": lambda: OnnxEncoderBatcher(
+            sam, inference_session(int8_path, options), 1, 0
+        ),
+    }
+    decoder = inference_session(decoder_path, options)
+    reference = None
+    for name, make_encoder in encoders.items():
+        encoder = make_encoder()
+        states, encode_times, peak = encode_all(encoder, samples)
+        # the batcher's thread keeps the encoder alive, let its session go
+        encoder.session = None
+        if name == "torch":
+            predictor = SamPredictor(sam)
+        else:
+            predictor = OnnxPredictor(sam, decoder)
+        masks, decode_times = decode_all(predictor, states, points)
+        if reference is None:
+            reference = masks
+        ious = [iou(a, b) for m, r in zip(masks, reference) for a, b in zip(m, r)]
+        print(
+            f"{name:8}  encode {statistics.median(encode_times) * 1000:8.0f}ms  "
+            f"+{peak:6.0f}MB peak  "
+            f"decode {statistics.median(decode_times) * 1000:6.1f}ms  "
+            f"IoU vs torch mean {statistics.fmean(ious):.4f} min {min(ious):.4f}"
+        )
+    sizes = {
+        path: os.path.getsize(path) / 1024**2
+        for path in (encoder_path, int8_path, decoder_path)
+    }
+    for path, mb in sizes.items():
+        print(f"{os.path.basename(path)}: {mb:.0f} MB")
+
+
+if __name__ == "__main__":
+    main()
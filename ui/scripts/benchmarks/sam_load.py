@@ -0,0 +1,135 @@
+"""Load test the SAM prompt path: the old single predictor behind a lock
+against the predictor pool with the batched encoder.
+
+Concurrent clients each send requests; "new" requests bring an image the
+server hasn't embedded yet, "click" requests prompt an already embedded
+one. Without --model_path the weights are random, which is fine for
+timing. Everything runs on the cpu. Run from the ui/scripts directory:
+    python -m benchmarks.sam_load --clients 1 4 8 --requests 4
+"""
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+import numpy as np
+from segment_anything import SamPredictor, sam_model_registry
+
+from predictors import EncoderBatcher, PredictorPool
+
+POINT = dict(point_coords=np.array([[100, 100]]), point_labels=np.array([1]))
+
+
+def make_images(count, height, width):
+    rng = np.random.default_rng(0)
+    return [
+        rng.integers(0, 256, (height, width, 3), dtype=np.uint8) for _ in range(count)
+    ]
+
+
+class LockedServer:
+    """What the server did before: one predictor, encode on every request."""
+
+    def __init__(self, sam):
+        self.predictor = SamPredictor(sam)
+        self.lock = threading.Lock()
+
+    def request(self, image, key):
+        with self.lock:
+            self.predictor.set_image(image)
+            self.predictor.predict(**POINT)
+            self.predictor.reset_image()
+
+
+class PooledServer:
+    def __init__(self, sam, predictors, batch, window):
+        self.pool = PredictorPool(sam, predictors)
+        self.encoder = EncoderBatcher(sam, batch, window)
+        self.embeddings = {}
+
+    def request(self, image, key):
+        state = self.embeddings.get(key)
+        if state is None:
+            state = self.embeddings[key] = self.encoder.encode(image, key)
+        with self.pool.predictor(state) as predictor:
+            predictor.predict(**POINT)
+
+
+def load(server, images, clients, requests, kind):
+    """Latencies of clients * requests concurrent requests."""
+    if kind == "click":
+        # embed first, the locked server has no cache and encodes anyway
+        for key, image in enumerate(images):
+            server.request(image, key)
+
+    def client(index):
+        latencies = []
+        for n in range(requests):
+            key = (index * requests + n) % len(images)
+            start = time.perf_counter()
+            server.request(images[key], key)
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(clients) as pool:
+        latencies = [x for xs in pool.map(client, range(clients)) for x in xs]
+    return time.perf_counter() - start, latencies
+
+
+@click.command()
+@click.option(
+    "--model",
+    default="vit_b",
+    type=click.Choice(["vit_b", "vit_l", "vit_h"]),
+)
+@click.option("--model_path", default=None, help="checkpoint, random weights if unset")
+@click.option("--clients", multiple=True, type=int, default=[1, 4, 8])
+@click.option("--requests", default=4, help="requests per client")
+@click.option("--size", nargs=2, type=int, default=(480, 640), help="height width")
+@click.option(
+    "--kinds",
+    multiple=True,
+    default=["new", "click"],
+    type=click.Choice(["new", "click"]),
+)
+@click.option("--predictors", default=4)
+@click.option("--encoder_batch", default=1, help="try 4 with a gpu")
+@click.option("--encoder_window_ms", default=10)
+def main(
+    model,
+    model_path,
+    clients,
+    requests,
+    size,
+    kinds,
+    predictors,
+    encoder_batch,
+    encoder_window_ms,
+):
+    sam = sam_model_registry[model](checkpoint=model_path)
+    sam.eval()
+    for kind in kinds:
+        for n_clients in clients:
+            images = make_images(n_clients * requests, *size)
+            servers = {
+                "lock": LockedServer(sam),
+                "pool": PooledServer(
+                    sam, predictors, encoder_batch, encoder_window_ms / 1000
+                ),
+            }
+            for name, server in servers.items():
+                elapsed, latencies = load(server, images, n_clients, requests, kind)
+                latencies.sort()
+                p95 = latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)]
+                print(
+                    f"{kind:5} {n_clients:2} clients {name}: "
+                    f"{len(latencies) / elapsed:7.2f} req/s  "
+                    f"p50 {statistics.median(latencies) * 1000:8.0f}ms  "
+                    f"p95 {p95 * 1000:8.0f}ms"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Least recently used cache bounded by the total size of its values.
+
+    size is a function returning the size in bytes of a value. Values larger
+    than the whole budget are not cached. Safe to share between threads.
+    """
+
+    def __init__(self, max_bytes, size):
+        self.max_bytes = max_bytes
+        self.size = size
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._items.move_to_end(key)
+            return item[0]
+
+    def put(self, key, value):
+        nbytes = self.size(value)
+        with self._lock:
+            self._remove(key)
+            if nbytes > self.max_bytes:
+                return
+            self._items[key] = (value, nbytes)
+            self.bytes += nbytes
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self._items)))
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._items.get(key)
+            self._remove(key)
+            if item is None:
+                return default
+            return item[0]
+
+    def get_or_create(self, key, create):
+        """Return the cached value for key, calling create() on a miss."""
+        value = self.get(key)
+        if value is None:
+            value = create()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.bytes = 0
+
+    def _remove(self, key):
+        item = self._items.pop(key, None)
+        if item is not None:
+            self.bytes -= item[1]
+
+    def stats(self):
+        return {
+            "entries": len(self._items),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,97 @@
+import clip
+import numpy as np
+import torch
+from PIL import Image
+from torchvision.transforms import Compose
+
+from cache import LRUCache
+
+
+def masked_crops(image: np.ndarray, masks):
+    """The box of every mask cut out of the image, black outside the mask."""
+    for mask in masks:
+        x, y, w, h = (int(v) for v in mask["bbox"])
+        # the boxes are inclusive, their width is max - min
+        region = (slice(y, y + h + 1), slice(x, x + w + 1))
+        crop = image[region].copy()
+        crop[~mask["segmentation"][region]] = 0
+        yield crop
+
+
+def batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def tensor_nbytes(tensor: torch.Tensor) -> int:
+    return tensor.element_size() * tensor.nelement()
+
+
+class ClipScorer:
+    """Scores the masks of an image against text prompts with CLIP.
+
+    image_features encodes the masked crops batch_size at a time: each crop
+    is resized and center cropped on its own, as clip's preprocess does,
+    then the batch is converted and normalized as one tensor. That keeps
+    memory flat however many masks an image has. Text features are cached
+    by text.
+    """
+
+    def __init__(
+        self,
+        model,
+        preprocess: Compose,
+        device=torch.device("cpu"),
+        batch_size: int = 32,
+        text_cache_bytes: int = 16 * 1024**2,
+    ):
+        self.model = model
+        self.device = device
+        self.batch_size = batch_size
+        # clip's preprocess: resize, center crop, to rgb, to tensor, normalize
+        self.resize = Compose(preprocess.transforms[:2])
+        self.normalize = preprocess.transforms[-1]
+        self.texts = LRUCache(text_cache_bytes, tensor_nbytes)
+
+    @torch.no_grad()
+    def image_features(self, image: np.ndarray, masks) -> torch.Tensor:
+        """Normalized CLIP features of the masked crops, one row per mask."""
+        features = []
+        for batch in batches(masked_crops(image, masks), self.batch_size):
+            pixels = np.stack(
+                [
+                    np.asarray(self.resize(Image.fromarray(crop).convert("RGB")))
+                    for crop in batch
+                ]
+            )
+            pixels = torch.as_tensor(pixels, device=self.device)
+            pixels = self.normalize(pixels.permute(0, 3, 1, 2).float() / 255)
+            features.append(self.model.encode_image(pixels).float())
+        if not features:
+            return torch.zeros((0, self.model.visual.output_dim), device=self.device)
+        features = torch.cat(features)
+        return features / features.norm(dim=-1, keepdim=True)
+
+    @torch.no_grad()
+    def text_features(self, text: str) -> torch.Tensor:
+        features = self.texts.get(text)
+        if features is None:
+            tokenized_text = clip.tokenize([text]).to(self.device)
+            features = self.model.encode_text(tokenized_text).float()[0]
+            features = features / features.norm()
+            self.texts.put(text, features)
+        return features
+
+    def scores(self, image_features: torch.Tensor, text: str) -> torch.Tensor:
+        """Softmax over the masks of their similarity to the text."""
+        probs = 100.0 * image_features @ self.text_features(text)
+        return probs.softmax(dim=-1)
+
+    def stats(self):
+        return {"batch_size": self.batch_size, "texts": self.texts.stats()}
@@ -1,13 +1,55 @@
+import functools
+import hashlib
+import json
+import os
+from typing import Callable
+
 import click
 import torch
+import torch.nn.functional as F
 from segment_anything.modeling import Sam
 from segment_anything import sam_model_registry
 from segment_anything.utils.onnx import SamOnnxModel
 
+OPSET = 17
+# bumped whenever the exported graphs change, so older exports are redone
+EXPORT_VERSION = 2
+VARIANTS = ("fp32", "fp16", "int8", "optimized")
+
+
+class DynamicSizeSamOnnxModel(SamOnnxModel):
+    """SamOnnxModel whose masks are cropped to orig_im_size at run time.
+
+    SamOnnxModel crops the padding with int() bounds, which the tracer
+    records as constants: the masks come out at any orig_im_size, but
+    cropped as for the dummy input's. Indexing with a range keeps the
+    bounds in the graph.
+    """
+
+    def mask_postprocessing(self, masks: torch.Tensor, orig_im_size: torch.Tensor):
+        masks = F.interpolate(
+            masks,
+            size=(self.img_size, self.img_size),
+            mode="bilinear",
+            align_corners=False,
+        )
+
+        prepadded_size = self.resize_longest_image_size(orig_im_size, self.img_size)
+        masks = masks.index_select(2, torch.arange(prepadded_size[0]))
+        masks = masks.index_select(3, torch.arange(prepadded_size[1]))
 
-def export(sam: Sam, model_output_path: str):
+        orig_im_size = orig_im_size.to(torch.int64)
+        h, w = orig_im_size[0], orig_im_size[1]
+        masks = F.interpolate(masks, size=(h, w), mode="bilinear", align_corners=False)
+        return masks
+
+
+def export(sam: Sam, model_output_path: str, return_single_mask: bool = True):
+    """Exports the prompt encoder and mask decoder. With return_single_mask
+    the model returns the best mask only, else all four like the torch mask
+    decoder: the single mask output first, then the three multimask ones."""
     sam = sam.to(torch.device("cpu"))
-    onnx_model = SamOnnxModel(sam, return_single_mask=True)
+    onnx_model = DynamicSizeSamOnnxModel(sam, return_single_mask=return_single_mask)
 
     embed_size = sam.prompt_encoder.image_embedding_size
     dummy_inputs = {
@@ -25,14 +67,18 @@ def export(sam: Sam, model_output_path: str):
         "orig_im_size": torch.tensor([1500, 2250], dtype=torch.float),
     }
 
+    # the TorchScript exporter: dynamic_axes and the traced index_select
+    # crop rely on it, and the dynamo one newer torch defaults to needs
+    # onnxscript
     with open(model_output_path, "wb") as f:
         torch.onnx.export(
             onnx_model,
             tuple(dummy_inputs.values()),
             f,
+            dynamo=False,
             export_params=True,
             verbose=False,
-            opset_version=17,
+            opset_version=OPSET,
             do_constant_folding=True,
             input_names=list(dummy_inputs.keys()),
             output_names=["masks", "iou_predictions", "low_res_masks"],
@@ -43,6 +89,168 @@ def export(sam: Sam, model_output_path: str):
         )
 
 
+def export_encoder(sam: Sam, model_output_path: str):
+    """Exports the image encoder, which takes a batch of images already
+    preprocessed by Sam.preprocess."""
+    sam = sam.to(torch.device("cpu"))
+    img_size = sam.image_encoder.img_size
+    dummy_input = torch.randn(1, 3, img_size, img_size, dtype=torch.float)
+
+    # a path rather than a file, vit_h is over the 2 GB a protobuf can hold
+    # and its weights are saved next to it. Without no_grad the traced
+    # forward pass keeps its activations, over 6 GB for vit_b.
+    with torch.no_grad():
+        torch.onnx.export(
+            sam.image_encoder,
+            (dummy_input,),
+            model_output_path,
+            dynamo=False,
+            export_params=True,
+            verbose=False,
+            opset_version=OPSET,
+            do_constant_folding=True,
+            input_names=["input_image"],
+            output_names=["image_embeddings"],
+            dynamic_axes={
+                "input_image": {0: "batch"},
+                "image_embeddings": {0: "batch"},
+            },
+        )
+
+
+def quantize(model_path: str, model_output_path: str):
+    """Dynamic int8 quantization: weights are stored in int8 and the matmuls
+    run in int8 with activations quantized on the fly."""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantize_dynamic(model_path, model_output_path, weight_type=QuantType.QUInt8)
+
+
+def to_fp16(model_path: str, model_output_path: str):
+    """Weights and math in float16. Inputs and outputs stay float32, so it's
+    a drop-in replacement."""
+    import onnx
+    from onnxruntime.transformers.float16 import convert_float_to_float16
+
+    model = convert_float_to_float16(onnx.load(model_path), keep_io_types=True)
+    onnx.save(model, model_output_path)
+
+
+def optimize(model_path: str, model_output_path: str):
+    """Saves the graph as ONNX Runtime optimizes it when loading. Only the
+    basic optimizations, the extended ones use operators of the CPU
+    execution provider that onnxruntime-web doesn't have."""
+    import onnxruntime as ort
+
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_BASIC
+    options.optimized_model_filepath = model_output_path
+    ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+
+
+def checkpoint_fingerprint(checkpoint_path: str, known=None):
+    """Size, mtime and blake2b hash of the checkpoint, None if there's no
+    file. The hash of known, an earlier fingerprint, is reused while the
+    size and mtime match: hashing vit_h takes seconds."""
+    if not checkpoint_path or not os.path.exists(checkpoint_path):
+        return None
+    stat = os.stat(checkpoint_path)
+    fingerprint = {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+    if known and all(known.get(key) == value for key, value in fingerprint.items()):
+        return known
+    digest = hashlib.blake2b()
+    with open(checkpoint_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024**2), b""):
+            digest.update(chunk)
+    return {**fingerprint, "blake2b": digest.hexdigest()}
+
+
+def read_manifest(manifest_path: str):
+    try:
+        with open(manifest_path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def cached_exports(manifest_path: str, checkpoint_path: str, exports):
+    """Runs the exports that are out of date and returns the manifest.
+
+    exports maps a name to (path, export), export(path) writes the model.
+    The manifest records the checkpoint, the opset and EXPORT_VERSION the
+    models were made with, and their files and sizes. When any of them
+    changed everything is exported again. Otherwise exports run from the
+    first one whose file is missing on, later ones may be made from its
+    file.
+    """
+    manifest = read_manifest(manifest_path)
+    known = manifest and manifest.get("checkpoint")
+    checkpoint = checkpoint_fingerprint(checkpoint_path, known)
+    stale = (
+        manifest is None
+        or manifest.get("opset") != OPSET
+        or manifest.get("version") != EXPORT_VERSION
+        or (known and known["blake2b"]) != (checkpoint and checkpoint["blake2b"])
+    )
+    done = {} if stale else manifest.get("exports", {})
+    manifest = {
+        "checkpoint": checkpoint,
+        "opset": OPSET,
+        "version": EXPORT_VERSION,
+        "exports": {},
+    }
+    redo = False
+    for name, (path, export) in exports.items():
+        file = os.path.basename(path)
+        redo = redo or done.get(name, {}).get("file") != file
+        redo = redo or not os.path.exists(path)
+        if redo:
+            print(f"exporting {name} to {path}")
+            export(path)
+        manifest["exports"][name] = {"file": file, "bytes": os.path.getsize(path)}
+
+    # written whole and then renamed, a crash never leaves half a manifest
+    with open(manifest_path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_path + ".tmp", manifest_path)
+    return manifest
+
+
+def variant_path(model_output_path: str, variant: str) -> str:
+    if variant == "fp32":
+        return model_output_path
+    return model_output_path.replace(".onnx", f".{variant}.onnx")
+
+
+def export_variants(
+    load_sam: Callable[[], Sam],
+    checkpoint_path: str,
+    model_output_path: str,
+    variants=("fp32",),
+):
+    """The single mask decoder for the browser and its variants, exported
+    if out of date, with their manifest at model_output_path + ".json".
+    load_sam is only called to export, an up to date model doesn't need it.
+
+    fp32 is always exported, the others are made from it: fp16 halves it,
+    int8 quantizes it like SAM's web demo does and optimized has ONNX
+    Runtime's graph optimizations applied ahead of time.
+    """
+    fp32_path = variant_path(model_output_path, "fp32")
+    makers = {
+        "fp32": lambda path: export(load_sam(), path),
+        "fp16": lambda path: to_fp16(fp32_path, path),
+        "int8": lambda path: quantize(fp32_path, path),
+        "optimized": lambda path: optimize(fp32_path, path),
+    }
+    exports = {
+        variant: (variant_path(model_output_path, variant), makers[variant])
+        for variant in VARIANTS
+        if variant == "fp32" or variant in variants
+    }
+    return cached_exports(model_output_path + ".json", checkpoint_path, exports)
+
+
 @click.command()
 @click.option(
     "--model",
@@ -56,9 +264,43 @@ def export(sam: Sam, model_output_path: str):
     default="model/sam_vit_b_01ec64.onnx",
     help="model output path",
 )
-def main(model: str, model_path: str, model_output_path: str):
-    sam = sam_model_registry[model](checkpoint=model_path)
-    export(sam, model_output_path)
+@click.option(
+    "--encoder_output_path",
+    default=None,
+    help="also export the image encoder here",
+)
+@click.option("--int8", is_flag=True, help="also write an int8 quantized encoder")
+@click.option(
+    "--variant",
+    multiple=True,
+    type=click.Choice(VARIANTS[1:]),
+    help="decoder variants to write besides fp32",
+)
+@click.option("--force", is_flag=True, help="export even if up to date")
+def main(
+    model: str,
+    model_path: str,
+    model_output_path: str,
+    encoder_output_path: str,
+    int8: bool,
+    variant,
+    force: bool,
+):
+    load_sam = functools.lru_cache(maxsize=None)(
+        lambda: sam_model_registry[model](checkpoint=model_path)
+    )
+    if force and os.path.exists(model_output_path + ".json"):
+        os.remove(model_output_path + ".json")
+    manifest = export_variants(load_sam, model_path, model_output_path, variant)
+    for name, info in manifest["exports"].items():
+        print(f"{name}: {info['file']} {info['bytes'] / 1024**2:.1f} MB")
+    if encoder_output_path:
+        export_encoder(load_sam(), encoder_output_path)
+        if int8:
+            quantize(
+                encoder_output_path,
+                encoder_output_path.replace(".onnx", ".int8.onnx"),
+            )
 
 
 if __name__ == "__main__":
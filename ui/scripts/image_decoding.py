@@ -0,0 +1,38 @@
+import io
+from typing import Optional, Tuple
+
+import numpy as np
+from PIL import Image
+from segment_anything.utils.transforms import ResizeLongestSide
+
+
+def open_image(file: bytes) -> Image.Image:
+    """The uploaded image, only its header is read until it's decoded."""
+    return Image.open(io.BytesIO(file))
+
+
+def decoded_size(size: Tuple[int, int], max_side: Optional[int] = None):
+    """The (height, width) decode_image gives an image of that size."""
+    height, width = size
+    if not max_side or max(height, width) <= max_side:
+        return size
+    return ResizeLongestSide.get_preprocess_shape(height, width, max_side)
+
+
+def decode_image(image: Image.Image, max_side: Optional[int] = None) -> np.ndarray:
+    """Decodes the image to an array, shrunk to max_side if it's larger.
+
+    With max_side at the SAM encoder's input size, the image comes out at
+    the size SAM resizes it to, without being decoded in full first: JPEGs
+    decode at 1/2, 1/4 or 1/8 scale (draft), then the image is reduced by a
+    whole factor and only the rest is resampled.
+    """
+    height, width = decoded_size((image.height, image.width), max_side)
+    if (height, width) != (image.height, image.width):
+        image.draft("RGB", (width, height))
+        if image.mode not in ("RGB", "RGBA", "L"):
+            image = image.convert("RGB")
+        image = image.resize((width, height), Image.BILINEAR, reducing_gap=2.0)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    return np.array(image)
@@ -0,0 +1,152 @@
+import base64
+import zlib
+from typing import Optional
+
+import numpy as np
+from fastapi import HTTPException, Request
+
+# formats of the "segmentation" field of the returned masks
+MASK_FORMATS = ("text", "rle", "packbits", "packbits_zlib")
+# what a mask of /api/point and /api/box can carry, all of it by default
+MASK_FIELDS = ("segmentation", "stability_score", "bbox", "area", "centroid")
+# Accept header media types asking for a format, text is the default
+MASK_MEDIA_TYPES = {
+    "application/x-sam-mask-rle": "rle",
+    "application/x-sam-mask-packbits": "packbits",
+    "application/x-sam-mask-packbits+zlib": "packbits_zlib",
+}
+
+
+def compress_mask(mask: np.ndarray):
+    """Text run lengths of the row major mask, like "12F3T40F"."""
+    flat_mask = mask.ravel()
+    idx = np.flatnonzero(np.diff(flat_mask))
+    idx = np.concatenate(([0], idx + 1, [len(flat_mask)]))
+    counts = np.diff(idx)
+    values = flat_mask[idx[:-1]]
+    compressed = "".join([f"{c}{'T' if v else 'F'}" for c, v in zip(counts, values)])
+    return compressed
+
+
+def rle_counts(mask: np.ndarray) -> np.ndarray:
+    """Column major run lengths, starting with a run of zeros.
+
+    The changes are found down the columns of the row major mask and sorted,
+    transposing the mask itself would be most of the work.
+    """
+    height, width = mask.shape
+    rows, cols = np.divmod(np.flatnonzero(mask[1:] != mask[:-1]), width)
+    # a column starting on another value than the previous one ended on
+    (wraps,) = np.nonzero(mask[0, 1:] != mask[-1, :-1])
+    changes = np.concatenate((cols * height + rows + 1, (wraps + 1) * height))
+    changes.sort()
+    counts = np.diff(np.concatenate(([0], changes, [height * width])))
+    if mask.size and mask[0, 0]:
+        counts = np.concatenate(([0], counts))
+    return counts
+
+
+def coco_rle(mask: np.ndarray) -> str:
+    """COCO's compressed RLE string of mask, as pycocotools.mask.encode
+    gives it, with the per run loop done on arrays.
+
+    Runs are stored as the difference to the run two before (from the
+    fourth one on), in 5 bit groups with a continuation bit, offset into
+    printable characters.
+    """
+    counts = rle_counts(mask).astype(np.int64)
+    values = counts.copy()
+    values[3:] -= counts[1:-2]
+
+    shifts = 5 * np.arange(7)
+    groups = (values[:, None] >> shifts) & 0x1F
+    rest = values[:, None] >> (shifts + 5)
+    last = np.where(groups & 0x10, rest == -1, rest == 0)
+    lengths = last.argmax(axis=1) + 1
+    more = np.arange(7) < (lengths - 1)[:, None]
+    chars = (groups | (more * 0x20)) + 48
+    return chars[np.arange(7) < lengths[:, None]].astype(np.uint8).tobytes().decode()
+
+
+def encode_mask(mask: np.ndarray, mask_format: str = "text"):
+    """The segmentation field of a mask in one of MASK_FORMATS.
+
+    rle is COCO's compressed RLE ({"size", "counts"}), which
+    pycocotools.mask.decode reads directly. packbits is the row major mask
+    at one bit per pixel, most significant bit first, base64 encoded,
+    zlib compressed first for packbits_zlib.
+    """
+    if mask_format == "text":
+        return compress_mask(mask)
+    size = list(mask.shape)
+    if mask_format == "rle":
+        return {"format": "rle", "size": size, "counts": coco_rle(mask)}
+    data = np.packbits(mask, axis=None).tobytes()
+    compressed = mask_format == "packbits_zlib"
+    if compressed:
+        data = zlib.compress(data, 1)
+    return {
+        "format": "packbits",
+        "size": size,
+        "zlib": compressed,
+        "data": base64.b64encode(data).decode(),
+    }
+
+
+def mask_geometry(masks: np.ndarray):
+    """Bounding boxes, areas and centroids of a stack of masks.
+
+    Everything comes from the per row and per column pixel counts, two
+    reductions over the stack. Boxes are XYWH with the width and height
+    SamAutomaticMaskGenerator gives (max - min, so 0 for a single pixel),
+    empty masks get a zero box and a NaN centroid (x, y).
+    """
+    _, height, width = masks.shape
+    row_counts = masks.sum(axis=2, dtype=np.int32)
+    col_counts = masks.sum(axis=1, dtype=np.int32)
+    area = row_counts.sum(axis=1)
+    rows = row_counts > 0
+    cols = col_counts > 0
+    top = rows.argmax(axis=1)
+    bottom = height - 1 - rows[:, ::-1].argmax(axis=1)
+    left = cols.argmax(axis=1)
+    right = width - 1 - cols[:, ::-1].argmax(axis=1)
+    bbox = np.stack((left, top, right - left, bottom - top), axis=1)
+    bbox[area == 0] = 0
+    with np.errstate(invalid="ignore", divide="ignore"):
+        centroid = np.stack(
+            (col_counts @ np.arange(width), row_counts @ np.arange(height)), axis=1
+        ) / area[:, None]
+    return bbox, area, centroid
+
+
+def mask_fields(fields: Optional[str] = None):
+    """FastAPI dependency for the comma separated fields query parameter,
+    eg. fields=bbox,area,centroid to leave out the segmentation."""
+    if fields is None:
+        return MASK_FIELDS
+    fields = tuple(field.strip() for field in fields.split(",") if field.strip())
+    unknown = set(fields) - set(MASK_FIELDS)
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"fields must be some of {', '.join(MASK_FIELDS)}",
+        )
+    return fields
+
+
+def mask_format(request: Request, mask_format: Optional[str] = None) -> str:
+    """FastAPI dependency picking the mask format from the mask_format query
+    parameter, or else the Accept header."""
+    if mask_format is not None:
+        if mask_format not in MASK_FORMATS:
+            raise HTTPException(
+                status_code=400,
+                detail=f"mask_format must be one of {', '.join(MASK_FORMATS)}",
+            )
+        return mask_format
+    for media_type in request.headers.get("accept", "").split(","):
+        media_type = media_type.split(";")[0].strip()
+        if media_type in MASK_MEDIA_TYPES:
+            return MASK_MEDIA_TYPES[media_type]
+    return "text"
@@ -0,0 +1,197 @@
+import math
+
+import numpy as np
+import torch
+from PIL import Image
+from segment_anything import SamAutomaticMaskGenerator, SamPredictor
+from segment_anything.utils.amg import (
+    MaskData,
+    area_from_rle,
+    batch_iterator,
+    box_xyxy_to_xywh,
+    generate_crop_boxes,
+    rle_to_mask,
+    uncrop_boxes_xyxy,
+    uncrop_points,
+)
+from torchvision.ops.boxes import batched_nms, box_area, box_iou
+
+from mask_encoding import mask_geometry
+from predictors import set_state
+
+
+class MaskGenerator(SamAutomaticMaskGenerator):
+    """SamAutomaticMaskGenerator on a predictor from the pool.
+
+    The image and its crops are embedded by embed(crop, region), so the
+    server's embedding cache and batched encoder are used. region is None
+    for the whole image at its own size, so /api/point and /api/box can
+    reuse that embedding. With max_side the image is shrunk to that long
+    side first, which saves most of the per point work on large images.
+    Only the masks that are kept get scaled back up.
+
+    generate gives the same masks as SamAutomaticMaskGenerator. stream
+    yields the masks of every batch of points as soon as it's decoded.
+    """
+
+    def __init__(self, predictor: SamPredictor, embed, max_side=None, **settings):
+        super().__init__(predictor.model, **settings)
+        self.predictor = predictor
+        self.embed = embed
+        self.max_side = max_side
+
+    def generate(self, image: np.ndarray):
+        size = image.shape[:2]
+        image = self._downscale(image)
+        crop_boxes, layer_idxs = generate_crop_boxes(
+            image.shape[:2], self.crop_n_layers, self.crop_overlap_ratio
+        )
+        data = MaskData()
+        for crop_box, layer_idx in zip(crop_boxes, layer_idxs):
+            crop_data = MaskData()
+            for batch_data in self._crop_batches(image, crop_box, layer_idx, size):
+                crop_data.cat(batch_data)
+            # duplicates within the crop
+            keep_by_nms = batched_nms(
+                crop_data["boxes"].float(),
+                crop_data["iou_preds"],
+                torch.zeros(len(crop_data["boxes"])),
+                iou_threshold=self.box_nms_thresh,
+            )
+            crop_data.filter(keep_by_nms)
+            data.cat(crop_data)
+
+        if len(crop_boxes) > 1:
+            # duplicates between crops, the ones from smaller crops are kept
+            scores = 1 / box_area(data["crop_boxes"])
+            scores = scores.to(data["boxes"].device)
+            keep_by_nms = batched_nms(
+                data["boxes"].float(),
+                scores,
+                torch.zeros(len(data["boxes"])),
+                iou_threshold=self.crop_nms_thresh,
+            )
+            data.filter(keep_by_nms)
+        data.to_numpy()
+        return self._records(data, image.shape[:2], size)
+
+    def stream(self, image: np.ndarray):
+        """Yields (masks, batches done, batches in all) after every batch.
+
+        Duplicates are removed as the masks come, a mask is dropped if it
+        overlaps one already sent by more than box_nms_thresh. That isn't
+        quite the NMS of generate, which sees every mask of a crop at once
+        and keeps the one with the best predicted IoU.
+        """
+        size = image.shape[:2]
+        image = self._downscale(image)
+        crop_boxes, layer_idxs = generate_crop_boxes(
+            image.shape[:2], self.crop_n_layers, self.crop_overlap_ratio
+        )
+        total = sum(
+            math.ceil(len(self.point_grids[layer_idx]) / self.points_per_batch)
+            for layer_idx in layer_idxs
+        )
+        done = 0
+        sent = None
+        for crop_box, layer_idx in zip(crop_boxes, layer_idxs):
+            for data in self._crop_batches(image, crop_box, layer_idx, size):
+                boxes = data["boxes"].float()
+                keep_by_nms = batched_nms(
+                    boxes,
+                    data["iou_preds"],
+                    torch.zeros(len(boxes)),
+                    iou_threshold=self.box_nms_thresh,
+                )
+                data.filter(keep_by_nms)
+                boxes = boxes[keep_by_nms]
+                if sent is not None and len(sent) and len(boxes):
+                    overlap = box_iou(boxes, sent).max(dim=1).values
+                    data.filter(overlap <= self.box_nms_thresh)
+                    boxes = boxes[overlap <= self.box_nms_thresh]
+                sent = boxes if sent is None else torch.cat((sent, boxes))
+                data.to_numpy()
+                done += 1
+                yield self._records(data, image.shape[:2], size), done, total
+
+    def _downscale(self, image):
+        height, width = image.shape[:2]
+        if not self.max_side or max(height, width) <= self.max_side:
+            return image
+        scale = self.max_side / max(height, width)
+        size = (max(round(width * scale), 1), max(round(height * scale), 1))
+        return np.asarray(Image.fromarray(image).resize(size, Image.BILINEAR))
+
+    def _crop_batches(self, image, crop_box, crop_layer_idx, size):
+        """MaskData of every batch of points of a crop, in the image frame,
+        like SamAutomaticMaskGenerator._process_crop."""
+        x0, y0, x1, y1 = crop_box
+        cropped_im = image[y0:y1, x0:x1, :]
+        cropped_im_size = cropped_im.shape[:2]
+        if cropped_im_size == size:
+            region = None
+        else:
+            region = f"{image.shape[0]}x{image.shape[1]}:{x0},{y0},{x1},{y1}"
+        set_state(self.predictor, self.embed(cropped_im, region))
+
+        points_scale = np.array(cropped_im_size)[None, ::-1]
+        points_for_image = self.point_grids[crop_layer_idx] * points_scale
+        for (points,) in batch_iterator(self.points_per_batch, points_for_image):
+            data = self._process_batch(
+                points, cropped_im_size, crop_box, image.shape[:2]
+            )
+            data["boxes"] = uncrop_boxes_xyxy(data["boxes"], crop_box)
+            data["points"] = uncrop_points(data["points"], crop_box)
+            data["crop_boxes"] = torch.tensor([crop_box for _ in data["rles"]])
+            yield data
+        self.predictor.reset_image()
+
+    def _records(self, data, image_size, size):
+        """Mask records like SamAutomaticMaskGenerator.generate's, with
+        binary masks, at the original size."""
+        if self.min_mask_region_area > 0:
+            data = self.postprocess_small_regions(
+                data,
+                self.min_mask_region_area,
+                max(self.box_nms_thresh, self.crop_nms_thresh),
+            )
+        records = []
+        for idx, rle in enumerate(data["rles"]):
+            records.append(
+                {
+                    "segmentation": rle_to_mask(rle),
+                    "area": area_from_rle(rle),
+                    "bbox": box_xyxy_to_xywh(data["boxes"][idx]).tolist(),
+                    "predicted_iou": data["iou_preds"][idx].item(),
+                    "point_coords": [data["points"][idx].tolist()],
+                    "stability_score": data["stability_score"][idx].item(),
+                    "crop_box": box_xyxy_to_xywh(data["crop_boxes"][idx]).tolist(),
+                }
+            )
+        if image_size != size:
+            for record in records:
+                upscale(record, image_size, size)
+        return records
+
+
+def upscale(record, image_size, size):
+    """Scales a mask record from the downscaled image to the original."""
+    height, width = size
+    scale_y, scale_x = height / image_size[0], width / image_size[1]
+    mask = Image.fromarray(record["segmentation"].astype(np.uint8) * 255)
+    mask = np.asarray(mask.resize((width, height), Image.BILINEAR)) > 127
+    bbox, area, _ = mask_geometry(mask[None])
+    points = [[x * scale_x, y * scale_y] for x, y in record["point_coords"]]
+    x, y, w, h = record["crop_box"]
+    record.update(
+        segmentation=mask,
+        bbox=bbox[0].tolist(),
+        area=int(area[0]),
+        point_coords=points,
+        crop_box=[
+            round(x * scale_x),
+            round(y * scale_y),
+            round(w * scale_x),
+            round(h * scale_y),
+        ],
+    )
@@ -0,0 +1,226 @@
+import contextlib
+import gc
+import itertools
+import os
+import threading
+import time
+import traceback
+import zipfile
+
+import torch
+from segment_anything import sam_model_registry
+from segment_anything.modeling import Sam
+
+
+def mappable_checkpoint(checkpoint_path: str) -> str:
+    """A checkpoint torch.load can memory-map. That's the checkpoint itself
+    in torch's zip format, as SAM's are, else a copy converted to it once,
+    next to the checkpoint."""
+    if zipfile.is_zipfile(checkpoint_path):
+        return checkpoint_path
+    converted = checkpoint_path.replace(".pth", ".mmap.pth")
+    if (
+        not os.path.exists(converted)
+        or os.path.getmtime(converted) < os.path.getmtime(checkpoint_path)
+    ):
+        state_dict = torch.load(checkpoint_path, map_location="cpu")
+        torch.save(state_dict, converted + ".tmp")
+        os.replace(converted + ".tmp", converted)
+    return converted
+
+
+def build_sam_mmap(model: str, checkpoint_path: str) -> Sam:
+    """sam_model_registry[model] with the checkpoint's weights memory-mapped
+    rather than read into memory.
+
+    The model is built on the meta device, which allocates and initializes
+    nothing, then its parameters are made views of the mapped file. The
+    pages are read on first use and shared through the page cache: every
+    process mapping the file uses the same copy, and once it's cached
+    loading takes milliseconds. Moving the model to a GPU copies it as
+    usual.
+    """
+    with torch.device("meta"):
+        sam = sam_model_registry[model]()
+    state_dict = torch.load(
+        mappable_checkpoint(checkpoint_path),
+        map_location="cpu",
+        mmap=True,
+        weights_only=True,
+    )
+    sam.load_state_dict(state_dict, assign=True)
+    # buffers that aren't saved would be left without values
+    missing = [
+        name
+        for name, tensor in itertools.chain(sam.named_parameters(), sam.named_buffers())
+        if tensor.is_meta
+    ]
+    if missing:
+        raise RuntimeError(f"not in the checkpoint: {', '.join(missing)}")
+    return sam
+
+
+class LazyModel:
+    """A model loaded by load() when first used, and dropped again.
+
+    use() is a context manager giving the model, loaded once however many
+    requests ask for it at the same time. unload() drops it when nothing is
+    using it, close(model) then releases what it holds besides memory, like
+    threads. A failed load is raised to every request waiting for it and
+    tried again by the next.
+    """
+
+    def __init__(self, load, close=None):
+        self.load = load
+        self.close = close
+        self.loads = 0
+        self.unloads = 0
+        self.load_seconds = None
+        self.error = None
+        self.last_used = None
+        self._model = None
+        self._users = 0
+        self._lock = threading.Lock()
+        # held while loading or unloading, so there's never two copies
+        self._load_lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._model is not None
+
+    @contextlib.contextmanager
+    def use(self):
+        model = self._acquire()
+        try:
+            yield model
+        finally:
+            with self._lock:
+                self._users -= 1
+                self.last_used = time.monotonic()
+
+    def _acquire(self):
+        with self._lock:
+            if self._model is not None:
+                self._users += 1
+                return self._model
+        with self._load_lock:
+            with self._lock:
+                if self._model is not None:
+                    self._users += 1
+                    return self._model
+            start = time.perf_counter()
+            try:
+                model = self.load()
+            except Exception as e:
+                self.error = repr(e)
+                raise
+            with self._lock:
+                self._model = model
+                self._users += 1
+                self.loads += 1
+                self.load_seconds = time.perf_counter() - start
+                self.error = None
+            return model
+
+    def unload(self, idle_for=0.0, wait=True):
+        """Drops the model if nothing has used it for idle_for seconds.
+        Without wait, gives up rather than wait for a load to finish."""
+        if not self._load_lock.acquire(blocking=wait):
+            return False
+        try:
+            with self._lock:
+                model = self._model
+                if model is None or self._users:
+                    return False
+                if time.monotonic() - (self.last_used or 0) < idle_for:
+                    return False
+                self._model = None
+                self.unloads += 1
+            if self.close is not None:
+                self.close(model)
+            del model
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            return True
+        finally:
+            self._load_lock.release()
+
+    def stats(self):
+        idle = None
+        if self.last_used is not None and not self._users:
+            idle = time.monotonic() - self.last_used
+        return {
+            "loaded": self.loaded,
+            "users": self._users,
+            "loads": self.loads,
+            "unloads": self.unloads,
+            "load_seconds": self.load_seconds,
+            "idle_seconds": idle,
+            "error": self.error,
+        }
+
+
+class ModelRegistry:
+    """The server's models by name, each loaded on first use.
+
+    With idle_timeout, a thread unloads the models nothing has used for
+    that long, except the preloaded ones. Those are the models a deployment
+    needs warm, readiness waits for them.
+    """
+
+    def __init__(self, idle_timeout=None):
+        self.idle_timeout = idle_timeout
+        self.models = {}
+        self.kept = set()
+        if idle_timeout:
+            threading.Thread(target=self._unload_idle, daemon=True).start()
+
+    def register(self, name, load, close=None):
+        self.models[name] = LazyModel(load, close)
+
+    def use(self, name):
+        return self.models[name].use()
+
+    def loaded(self, name):
+        """The model if it's loaded, else None, without loading it."""
+        return self.models[name]._model
+
+    def warm_up(self, names=None):
+        """Loads the models, all of them unless names are given."""
+        for name in self.models if names is None else names:
+            with self.use(name):
+                pass
+
+    def preload(self, names):
+        """Loads the models in the background and keeps them loaded."""
+        self.kept.update(names)
+
+        def run():
+            try:
+                self.warm_up(names)
+            except Exception:
+                traceback.print_exc()
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def ready(self):
+        return all(self.models[name].loaded for name in self.kept)
+
+    def _unload_idle(self):
+        interval = min(self.idle_timeout / 4, 30)
+        while True:
+            time.sleep(interval)
+            for name, model in self.models.items():
+                if name not in self.kept:
+                    model.unload(self.idle_timeout, wait=False)
+
+    def stats(self):
+        return {
+            "ready": self.ready(),
+            "idle_timeout": self.idle_timeout,
+            "models": {
+                name: {**model.stats(), "keep": name in self.kept}
+                for name, model in self.models.items()
+            },
+        }
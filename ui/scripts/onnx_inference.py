@@ -0,0 +1,150 @@
+import numpy as np
+import onnxruntime as ort
+import torch
+from segment_anything.modeling import Sam
+from segment_anything.utils.transforms import ResizeLongestSide
+
+import export_onnx_model
+from predictors import EncoderBatcher
+
+
+def session_options(
+    intra_op_threads: int = 0, inter_op_threads: int = 1, mem_arena: bool = False
+):
+    """Options for CPU inference sessions.
+
+    intra_op_threads splits each operator, 0 uses one thread per physical
+    core. The graphs are sequential, so one inter op thread is enough, more
+    only compete with the intra op ones. Without the memory arena the
+    encoder's activations are given back after every run instead of staying
+    resident, vit_b's are close to 2GB, for no loss of speed after the first.
+    """
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    options.intra_op_num_threads = intra_op_threads
+    options.inter_op_num_threads = inter_op_threads
+    options.enable_cpu_mem_arena = mem_arena
+    return options
+
+
+def inference_session(model_path: str, options: ort.SessionOptions):
+    return ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+
+
+def runtime_models(sam: Sam, model_path: str, int8: bool = False):
+    """Paths of the encoder and the all masks decoder next to the
+    checkpoint, exported first unless they're up to date."""
+    encoder_path = model_path.replace(".pth", "_encoder.onnx")
+    decoder_path = model_path.replace(".pth", "_decoder.onnx")
+    exports = {
+        "encoder": (
+            encoder_path,
+            lambda path: export_onnx_model.export_encoder(sam, path),
+        )
+    }
+    if int8:
+        fp32_path = encoder_path
+        int8_path = encoder_path.replace(".onnx", ".int8.onnx")
+        exports["encoder int8"] = (
+            int8_path,
+            lambda path: export_onnx_model.quantize(fp32_path, path),
+        )
+        encoder_path = int8_path
+    exports["decoder"] = (
+        decoder_path,
+        lambda path: export_onnx_model.export(sam, path, return_single_mask=False),
+    )
+    export_onnx_model.cached_exports(
+        model_path.replace(".pth", "_runtime.json"), model_path, exports
+    )
+    return encoder_path, decoder_path
+
+
+class OnnxEncoderBatcher(EncoderBatcher):
+    """EncoderBatcher running the exported image encoder in ONNX Runtime."""
+
+    def __init__(self, sam: Sam, session: ort.InferenceSession, *args, **kwargs):
+        self.session = session
+        super().__init__(sam, *args, **kwargs)
+
+    def _image_encoder(self, input_images: torch.Tensor) -> torch.Tensor:
+        (features,) = self.session.run(
+            None, {"input_image": input_images.cpu().numpy()}
+        )
+        return torch.from_numpy(features).to(self.sam.device)
+
+
+class OnnxPredictor:
+    """SamPredictor.predict on the exported decoder.
+
+    Holds an image embedding like a SamPredictor, set with
+    predictors.set_state, so PredictorPool can hand them out. They all share
+    one session, ONNX Runtime runs a session from several threads at once.
+    """
+
+    def __init__(self, sam: Sam, session: ort.InferenceSession):
+        self.session = session
+        self.transform = ResizeLongestSide(sam.image_encoder.img_size)
+        self.mask_threshold = sam.mask_threshold
+        self.mask_input_size = sam.prompt_encoder.mask_input_size
+        self.postprocess_masks = sam.postprocess_masks
+        self.reset_image()
+
+    def predict(
+        self,
+        point_coords=None,
+        point_labels=None,
+        box=None,
+        mask_input=None,
+        multimask_output: bool = True,
+        return_logits: bool = False,
+    ):
+        if not self.is_image_set:
+            raise RuntimeError("An image must be set before mask prediction.")
+
+        coords = []
+        labels = []
+        if point_coords is not None:
+            coords.append(self.transform.apply_coords(point_coords, self.original_size))
+            labels.append(point_labels)
+        if box is not None:
+            box = self.transform.apply_boxes(box, self.original_size)
+            coords.append(box.reshape(-1, 2))
+            labels.append([2, 3])
+        else:
+            # the prompt encoder pads the points like this when there's no box
+            coords.append(np.zeros((1, 2)))
+            labels.append([-1])
+        has_mask_input = np.array([mask_input is not None], dtype=np.float32)
+        if mask_input is None:
+            mask_input = np.zeros((1, *self.mask_input_size))
+
+        _, iou_predictions, low_res_masks = self.session.run(
+            None,
+            {
+                "image_embeddings": self.features.cpu().numpy(),
+                "point_coords": np.concatenate(coords)[None].astype(np.float32),
+                "point_labels": np.concatenate(labels)[None].astype(np.float32),
+                "mask_input": mask_input[None].astype(np.float32),
+                "has_mask_input": has_mask_input,
+                "orig_im_size": np.array(self.original_size, dtype=np.float32),
+            },
+        )
+        # the single mask output comes first, as in MaskDecoder
+        outputs = slice(1, None) if multimask_output else slice(0, 1)
+        low_res_masks = low_res_masks[:, outputs]
+        # upscaled here rather than taken from the model, which upscales all
+        # four masks
+        masks = self.postprocess_masks(
+            torch.from_numpy(low_res_masks), self.input_size, self.original_size
+        )[0].numpy()
+        if not return_logits:
+            masks = masks > self.mask_threshold
+        return masks, iou_predictions[0, outputs], low_res_masks[0]
+
+    def reset_image(self):
+        self.is_image_set = False
+        self.features = None
+        self.original_size = None
+        self.input_size = None
@@ -0,0 +1,142 @@
+import contextlib
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+import torch
+from segment_anything import SamPredictor
+from segment_anything.modeling import Sam
+from segment_anything.utils.transforms import ResizeLongestSide
+
+
+def set_state(predictor: SamPredictor, state):
+    """Sets the predictor to an image embedding from EncoderBatcher."""
+    predictor.features, predictor.original_size, predictor.input_size = state
+    predictor.is_image_set = True
+
+
+class PredictorPool:
+    """SamPredictors sharing one model, for running prompts concurrently.
+
+    A predictor only holds the state of the image it was set to, so any
+    number of them can use the same weights. make_predictor builds one from
+    the model, a SamPredictor unless given.
+    """
+
+    def __init__(self, sam: Sam, size: int, make_predictor=SamPredictor):
+        self.size = size
+        self._idle = queue.Queue()
+        for _ in range(size):
+            self._idle.put(make_predictor(sam))
+
+    @contextlib.contextmanager
+    def predictor(self, state=None):
+        """A predictor, set to state if one is given."""
+        predictor = self._idle.get()
+        try:
+            if state is not None:
+                set_state(predictor, state)
+            yield predictor
+        finally:
+            predictor.reset_image()
+            self._idle.put(predictor)
+
+
+class EncoderBatcher:
+    """Runs the SAM image encoder on images from concurrent requests at once.
+
+    The first image waits up to window seconds for others, up to max_batch
+    of them go through the encoder as one batch. Requests for an image
+    already being encoded share its result. encode returns the state a
+    SamPredictor keeps for an image: features, original and input size.
+    """
+
+    def __init__(self, sam: Sam, max_batch: int = 4, window: float = 0.01):
+        self.sam = sam
+        self.max_batch = max_batch
+        self.window = window
+        self.transform = ResizeLongestSide(sam.image_encoder.img_size)
+        self.batches = 0
+        self.images = 0
+        self._queue = queue.Queue()
+        self._pending = {}
+        self._lock = threading.Lock()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def encode(self, image: np.ndarray, key=None):
+        with self._lock:
+            future = self._pending.get(key) if key is not None else None
+            if future is None:
+                future = Future()
+                if key is not None:
+                    self._pending[key] = future
+                self._queue.put((image, key, future))
+        return future.result()
+
+    def close(self):
+        """Stops the encoder thread once the images queued are encoded. The
+        thread holds the model until then."""
+        self._queue.put(None)
+
+    def _run(self):
+        closed = False
+        while not closed:
+            batch = [self._queue.get()]
+            if batch[0] is None:
+                return
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get(timeout=deadline - time.monotonic())
+                except (queue.Empty, ValueError):
+                    # ValueError: the deadline already passed
+                    break
+                if item is None:
+                    closed = True
+                    break
+                batch.append(item)
+
+            try:
+                states = self._encode([image for image, _, _ in batch])
+            except Exception as e:
+                states = [e] * len(batch)
+            with self._lock:
+                for (_, key, future), state in zip(batch, states):
+                    self._pending.pop(key, None)
+                    if isinstance(state, Exception):
+                        future.set_exception(state)
+                    else:
+                        future.set_result(state)
+
+    @torch.no_grad()
+    def _encode(self, images):
+        """SamPredictor.set_image for several images in one encoder pass."""
+        inputs = []
+        sizes = []
+        for image in images:
+            input_image = self.transform.apply_image(image)
+            input_image = torch.as_tensor(input_image, device=self.sam.device)
+            input_image = input_image.permute(2, 0, 1).contiguous()[None, :, :, :]
+            sizes.append((image.shape[:2], tuple(input_image.shape[-2:])))
+            inputs.append(self.sam.preprocess(input_image))
+        features = self._image_encoder(torch.cat(inputs))
+        self.batches += 1
+        self.images += len(images)
+        # cloned, so that evicting one image frees its memory
+        return [
+            (features[i : i + 1].clone(), original_size, input_size)
+            for i, (original_size, input_size) in enumerate(sizes)
+        ]
+
+    def _image_encoder(self, input_images: torch.Tensor) -> torch.Tensor:
+        return self.sam.image_encoder(input_images)
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "images": self.images,
+            "max_batch": self.max_batch,
+            "window": self.window,
+        }
@@ -1,20 +1,42 @@
+import hashlib
 import io
+import json
 import os
 import click
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, Response, StreamingResponse
 import torch
 import numpy as np
 import uvicorn
 import clip
 
 import export_onnx_model
-from fastapi import FastAPI, File, Form
-from pydantic import BaseModel
-from typing import Sequence, Callable
-from segment_anything import SamPredictor, SamAutomaticMaskGenerator, sam_model_registry
+from cache import LRUCache
+from clip_scoring import ClipScorer
+from mask_encoding import (
+    MASK_FIELDS,
+    encode_mask,
+    mask_fields,
+    mask_format,
+    mask_geometry,
+)
+from image_decoding import decode_image, decoded_size, open_image
+from mask_generator import MaskGenerator
+from onnx_inference import (
+    OnnxEncoderBatcher,
+    OnnxPredictor,
+    inference_session,
+    runtime_models,
+    session_options,
+)
+from models import ModelRegistry, build_sam_mmap
+from predictors import EncoderBatcher, PredictorPool
+from fastapi import Depends, FastAPI, File, Form, HTTPException
+from pydantic import BaseModel, Field, ValidationError
+from typing import Sequence, Callable, Literal, NamedTuple, Optional
+from segment_anything import sam_model_registry
+from segment_anything.modeling import Sam
 from PIL import Image
 from typing_extensions import Annotated
-from threading import Lock
 
 
 class Point(BaseModel):
@@ -34,35 +56,96 @@ class Box(BaseModel):
     y2: int
 
 
+class GeneratorSettings(BaseModel):
+    """Automatic mask generation settings of /api/everything, SAM's defaults
+    unless set. max_side shrinks larger images to that long side first."""
+
+    points_per_side: int = Field(32, ge=1, le=64)
+    points_per_batch: int = Field(64, ge=1, le=256)
+    crop_n_layers: int = Field(0, ge=0, le=3)
+    crop_n_points_downscale_factor: int = Field(1, ge=1, le=8)
+    max_side: Optional[int] = Field(None, ge=64)
+
+
 class TextPrompt(BaseModel):
     text: str
 
 
-def segment_image(image_array: np.ndarray, segmentation_mask: np.ndarray):
-    segmented_image = np.zeros_like(image_array)
-    segmented_image[segmentation_mask] = image_array[segmentation_mask]
-    return segmented_image
+class SamRuntime(NamedTuple):
+    """SAM with what serves its prompts, loaded and unloaded together."""
 
+    sam: Sam
+    encoder: EncoderBatcher
+    predictor_pool: PredictorPool
+    prompt_pool: PredictorPool
+    embeddings: LRUCache
+
+
+class ClipRuntime(NamedTuple):
+    scorer: ClipScorer
+    indexes: LRUCache
+
+
+def image_key(file: bytes) -> str:
+    return hashlib.blake2b(file, digest_size=16).hexdigest()
+
+
+def embedding_nbytes(state) -> int:
+    features = state[0]
+    return features.element_size() * features.nelement()
+
+
+def pack_masks(masks):
+    """Masks with their segmentation packed to a bit per pixel, to cache."""
+    return [
+        {**mask, "segmentation": np.packbits(mask["segmentation"])} for mask in masks
+    ]
+
+
+def unpack_mask(mask, size):
+    segmentation = np.unpackbits(mask["segmentation"], count=size[0] * size[1])
+    return {**mask, "segmentation": segmentation.reshape(size).astype(bool)}
+
+
+def clip_index_nbytes(index) -> int:
+    masks, _, features = index
+    # plus a rough kilobyte for the other fields of a mask
+    masks_nbytes = sum(mask["segmentation"].nbytes + 1024 for mask in masks)
+    return masks_nbytes + features.element_size() * features.nelement()
+
+
+def prompt_state(state, size, mask_size="full"):
+    """The embedding state to decode a prompt on, and the scale of the
+    prompt's coordinates into it.
+
+    A predictor maps prompts from the state's original size to the encoder
+    input, and upscales the low res masks to it. With the image's full size
+    there, an embedding of the decoded image gives full size masks, upscaled
+    once. With mask_size "decoded" they stay at the decoded size.
+    """
+    features, decoded, input_size = state
+    frame = tuple(size) if mask_size == "full" else decoded
+    scale = np.array([frame[1] / size[1], frame[0] / size[0]])
+    return (features, frame, input_size), scale
 
-def retrieve(
-    elements: Sequence[np.ndarray],
-    search_text: str,
-    preprocess: Callable[[Image.Image], torch.Tensor],
-    model,
-    device=torch.device("cpu"),
-) -> torch.Tensor:
-    with torch.no_grad():
-        preprocessed_images = [
-            preprocess(Image.fromarray(image)).to(device) for image in elements
-        ]
-        tokenized_text = clip.tokenize([search_text]).to(device)
-        stacked_images = torch.stack(preprocessed_images)
-        image_features = model.encode_image(stacked_images)
-        text_features = model.encode_text(tokenized_text)
-        image_features /= image_features.norm(dim=-1, keepdim=True)
-        text_features /= text_features.norm(dim=-1, keepdim=True)
-        probs = 100.0 * image_features @ text_features.T
-    return probs[:, 0].softmax(dim=-1)
+
+def prompt_masks(masks, scores, encoding="text", fields=MASK_FIELDS):
+    """The response masks of a prompt, best first, with only the fields
+    asked for. Leaving out the segmentation skips encoding it."""
+    bbox, area, centroid = mask_geometry(masks)
+    records = []
+    for idx in np.argsort(-scores, kind="stable"):
+        record = {
+            "segmentation": None,
+            "stability_score": float(scores[idx]),
+            "bbox": bbox[idx].tolist(),
+            "area": int(area[idx]),
+            "centroid": None if area[idx] == 0 else centroid[idx].tolist(),
+        }
+        if "segmentation" in fields:
+            record["segmentation"] = encode_mask(masks[idx], encoding)
+        records.append({field: record[field] for field in fields})
+    return records
 
 
 @click.command()
@@ -73,13 +156,89 @@ def retrieve(
     type=click.Choice(["vit_b", "vit_l", "vit_h"]),
 )
 @click.option("--model_path", default="model/sam_vit_b_01ec64.pth", help="model path")
+@click.option(
+    "--mmap",
+    is_flag=True,
+    help="memory-map the weights, processes serving the same checkpoint share them",
+)
 @click.option("--port", default=8000, help="port")
 @click.option("--host", default="0.0.0.0", help="host")
+@click.option(
+    "--embedding_cache_mb",
+    default=512,
+    help="memory for cached image embeddings, 4 MB each",
+)
+@click.option("--predictors", default=4, help="prompts decoded concurrently")
+@click.option(
+    "--encoder_batch",
+    default=None,
+    type=int,
+    help="images encoded in one pass, 4 on cuda and 1 otherwise",
+)
+@click.option(
+    "--encoder_window_ms",
+    default=10,
+    help="how long an image waits for others to batch with",
+)
+@click.option(
+    "--clip_cache_mb",
+    default=256,
+    help="memory for the cached masks and CLIP features of /api/clip images",
+)
+@click.option("--clip_batch", default=32, help="mask crops CLIP encodes at once")
+@click.option(
+    "--decode_max_side",
+    default=1024,
+    help="prompt images are decoded down to this long side, 0 for full size",
+)
+@click.option(
+    "--onnx_variant",
+    multiple=True,
+    default=["int8"],
+    type=click.Choice(export_onnx_model.VARIANTS[1:]),
+    help="/sam_vit.onnx variants besides fp32",
+)
+@click.option(
+    "--onnx",
+    is_flag=True,
+    help="run the image encoder and the prompt decoder in ONNX Runtime",
+)
+@click.option("--onnx_int8", is_flag=True, help="with --onnx, an int8 image encoder")
+@click.option(
+    "--onnx_threads",
+    default=0,
+    help="ONNX Runtime threads per operator, 0 for one per core",
+)
+@click.option(
+    "--preload",
+    multiple=True,
+    type=click.Choice(["sam", "clip", "web_decoder"]),
+    help="load at startup and keep loaded, /health/ready waits for these",
+)
+@click.option(
+    "--idle_unload_s",
+    default=0,
+    help="unload models unused for this many seconds, 0 never",
+)
 def main(
     model,
     model_path,
+    mmap,
     port,
     host,
+    embedding_cache_mb,
+    predictors,
+    encoder_batch,
+    encoder_window_ms,
+    clip_cache_mb,
+    clip_batch,
+    decode_max_side,
+    onnx_variant,
+    onnx,
+    onnx_int8,
+    onnx_threads,
+    preload,
+    idle_unload_s,
 ):
     device = torch.device("cpu")
     try:
@@ -89,17 +248,73 @@ def main(
         device = torch.device("cpu")
     device = torch.device("cuda") if torch.cuda.is_available() else device
     print("device:", device)
+    # on cpu the encoder already uses every core and a batch only multiplies
+    # its memory, 2.5 GB per vit_b image
+    encoder_batch = encoder_batch or (4 if device.type == "cuda" else 1)
+
+    def build_sam():
+        if mmap:
+            return build_sam_mmap(model, model_path)
+        return sam_model_registry[model](checkpoint=model_path)
+
+    def load_sam():
+        sam = build_sam().to(device)
+        # prompts run on a pool of predictors sharing the weights, images they
+        # haven't seen go through the encoder in batches
+        predictor_pool = PredictorPool(sam, predictors)
+        if onnx:
+            # clicks and boxes are decoded by the exported decoder, the
+            # automatic mask generation keeps the torch one to decode a batch
+            # of points
+            encoder_path, decoder_path = runtime_models(sam, model_path, onnx_int8)
+            options = session_options(onnx_threads)
+            encoder = OnnxEncoderBatcher(
+                sam,
+                inference_session(encoder_path, options),
+                encoder_batch,
+                encoder_window_ms / 1000,
+            )
+            decoder = inference_session(decoder_path, options)
+            prompt_pool = PredictorPool(
+                sam, predictors, lambda sam: OnnxPredictor(sam, decoder)
+            )
+            # the torch encoder isn't used anymore, free its weights
+            sam.image_encoder.to("meta")
+        else:
+            encoder = EncoderBatcher(sam, encoder_batch, encoder_window_ms / 1000)
+            prompt_pool = predictor_pool
+        # encoder output by image hash, so that follow-up prompts on the same
+        # image only run the mask decoder
+        embeddings = LRUCache(embedding_cache_mb * 1024**2, embedding_nbytes)
+        return SamRuntime(sam, encoder, predictor_pool, prompt_pool, embeddings)
 
-    build_sam = sam_model_registry[model]
-    sam = build_sam(checkpoint=model_path).to(device)
-    onnx_model_path = model_path.replace(".pth", ".onnx")
-    if not os.path.exists(onnx_model_path):
-        export_onnx_model.export(sam, onnx_model_path)
-    predictor = SamPredictor(sam)
-    mask_generator = SamAutomaticMaskGenerator(sam)
-    sam_model_lock = Lock()
+    def load_clip():
+        clip_model, preprocess = clip.load("ViT-B/16", device=device)
+        # masks of an image and their CLIP features by image hash, another
+        # prompt on the image only needs the text encoded
+        return ClipRuntime(
+            ClipScorer(clip_model, preprocess, device, clip_batch),
+            LRUCache(clip_cache_mb * 1024**2, clip_index_nbytes),
+        )
+
+    def load_web_decoder():
+        """The manifest of the browser's decoders, exported again only when
+        the checkpoint changed. SAM is only loaded to export, a CPU copy of
+        its own: export moves the model it's given to the CPU, and with
+        --onnx the served one has no image encoder left."""
+        return export_onnx_model.export_variants(
+            build_sam,
+            model_path,
+            model_path.replace(".pth", ".onnx"),
+            onnx_variant,
+        )
 
-    clip_model, preprocess = clip.load("ViT-B/16", device=device)
+    # models load when a request first needs them, so the server starts at
+    # once and deployments that never call /api/clip never load CLIP
+    registry = ModelRegistry(idle_unload_s or None)
+    registry.register("sam", load_sam, close=lambda runtime: runtime.encoder.close())
+    registry.register("clip", load_clip)
+    registry.register("web_decoder", load_web_decoder)
 
     app = FastAPI()
 
@@ -107,133 +322,257 @@ def main(
     def index():
         return {"code": 0, "data": "Hello World"}
 
+    @app.get("/health/live")
+    def health_live():
+        return {"code": 0, "data": "alive"}
+
+    @app.get("/health/ready")
+    def health_ready():
+        """503 until the --preload models are loaded."""
+        stats = registry.stats()
+        if not stats["ready"]:
+            raise HTTPException(status_code=503, detail=stats)
+        return {"code": 0, "data": stats}
+
+    @app.get("/api/models")
+    def api_models():
+        return {"code": 0, "data": registry.stats()}
+
+    @app.post("/api/warmup")
+    def api_warmup(models: Optional[str] = None):
+        """Loads the comma separated models, all of them if none are given."""
+        names = None if models is None else [m for m in models.split(",") if m]
+        unknown = set(names or ()) - set(registry.models)
+        if unknown:
+            raise HTTPException(
+                status_code=400,
+                detail=f"unknown models {', '.join(sorted(unknown))}, "
+                f"there are {', '.join(registry.models)}",
+            )
+        registry.warm_up(names)
+        return {"code": 0, "data": registry.stats()}
+
     @app.get("/sam_vit.onnx")
-    def forward_onnx():
-        return FileResponse(onnx_model_path)
-
-    def compress_mask(mask: np.ndarray):
-        flat_mask = mask.ravel()
-        idx = np.flatnonzero(np.diff(flat_mask))
-        idx = np.concatenate(([0], idx + 1, [len(flat_mask)]))
-        counts = np.diff(idx)
-        values = flat_mask[idx[:-1]]
-        compressed = "".join(
-            [f"{c}{'T' if v else 'F'}" for c, v in zip(counts, values)]
-        )
-        return compressed
+    def forward_onnx(variant: str = "fp32"):
+        """The decoder for the browser, variant=smallest for the one with the
+        fewest bytes. The variant sent is in the X-Model-Variant header."""
+        with registry.use("web_decoder") as onnx_models:
+            exports = onnx_models["exports"]
+        if variant == "smallest":
+            variant = min(exports, key=lambda name: exports[name]["bytes"])
+        if variant not in exports:
+            raise HTTPException(
+                status_code=404,
+                detail=f"no {variant} model, there are {', '.join(exports)}",
+            )
+        path = os.path.join(os.path.dirname(model_path), exports[variant]["file"])
+        return FileResponse(path, headers={"X-Model-Variant": variant})
+
+    @app.get("/api/onnx")
+    def api_onnx():
+        with registry.use("web_decoder") as onnx_models:
+            return {"code": 0, "data": onnx_models}
+
+    def encode(runtime: SamRuntime, key: str, load: Callable[[], np.ndarray]):
+        """The embedding of the image load returns, encoded only if key
+        isn't cached."""
+        state = runtime.embeddings.get(key)
+        if state is None:
+            state = runtime.encoder.encode(load(), key)
+            runtime.embeddings.put(key, state)
+        return state
+
+    def embed(runtime: SamRuntime, file: bytes):
+        """The embedding of the image decoded to --decode_max_side, encoded
+        only if it isn't cached, and the image's full size."""
+        image = open_image(file)
+        size = (image.height, image.width)
+        key = image_key(file)
+        if decoded_size(size, decode_max_side) != size:
+            height, width = decoded_size(size, decode_max_side)
+            key = f"{key}:{height}x{width}"
+        state = encode(runtime, key, lambda: decode_image(image, decode_max_side))
+        return state, size
+
+    def crop_embedder(runtime: SamRuntime, file: bytes):
+        """MaskGenerator's embed for the image, crops are cached too."""
+        key = image_key(file)
+
+        def embed_crop(crop: np.ndarray, region: Optional[str]):
+            region_key = key if region is None else f"{key}:{region}"
+            return encode(runtime, region_key, lambda: crop)
+
+        return embed_crop
+
+    def clip_index(clip_runtime: ClipRuntime, file: bytes):
+        """Masks of the image, its size and their CLIP features, generated
+        only if the image isn't cached. Only then is SAM needed."""
+        key = image_key(file)
+        index = clip_runtime.indexes.get(key)
+        if index is None:
+            image_array = np.array(Image.open(io.BytesIO(file)))
+            with registry.use("sam") as runtime:
+                with runtime.predictor_pool.predictor() as predictor:
+                    generator = MaskGenerator(predictor, crop_embedder(runtime, file))
+                    masks = generator.generate(image_array)
+            features = clip_runtime.scorer.image_features(image_array, masks)
+            index = (pack_masks(masks), image_array.shape[:2], features)
+            clip_runtime.indexes.put(key, index)
+        return index
 
     @app.post("/api/point")
-    async def api_points(
+    def api_points(
         file: Annotated[bytes, File()],
         points: Annotated[str, Form(...)],
+        response: Response,
+        encoding: Annotated[str, Depends(mask_format)],
+        fields: Annotated[Sequence[str], Depends(mask_fields)],
+        mask_size: Literal["full", "decoded"] = "full",
     ):
+        response.headers["Vary"] = "Accept"
         ps = Points.parse_raw(points)
         input_points = np.array([[p.x, p.y] for p in ps.points])
         input_labels = np.array(ps.points_labels)
-        image_data = Image.open(io.BytesIO(file))
-        image_array = np.array(image_data)
-        with sam_model_lock:
-            predictor.set_image(image_array)
-            masks, scores, logits = predictor.predict(
-                point_coords=input_points,
-                point_labels=input_labels,
-                multimask_output=True,
-            )
-            predictor.reset_image()
-        masks = [
-            {
-                "segmentation": compress_mask(np.array(mask)),
-                "stability_score": float(scores[idx]),
-                "bbox": [0, 0, 0, 0],
-                "area": np.sum(mask).item(),
-            }
-            for idx, mask in enumerate(masks)
-        ]
-        masks = sorted(masks, key=lambda x: x["stability_score"], reverse=True)
-        return {"code": 0, "data": masks[:]}
+        with registry.use("sam") as runtime:
+            state, scale = prompt_state(*embed(runtime, file), mask_size)
+            with runtime.prompt_pool.predictor(state) as predictor:
+                masks, scores, logits = predictor.predict(
+                    point_coords=input_points * scale,
+                    point_labels=input_labels,
+                    multimask_output=True,
+                )
+        response.headers["X-Mask-Size"] = f"{masks.shape[1]}x{masks.shape[2]}"
+        return {"code": 0, "data": prompt_masks(masks, scores, encoding, fields)}
 
     @app.post("/api/box")
-    async def api_box(
+    def api_box(
         file: Annotated[bytes, File()],
         box: Annotated[str, Form(...)],
+        response: Response,
+        encoding: Annotated[str, Depends(mask_format)],
+        fields: Annotated[Sequence[str], Depends(mask_fields)],
+        mask_size: Literal["full", "decoded"] = "full",
     ):
+        response.headers["Vary"] = "Accept"
         b = Box.parse_raw(box)
         input_box = np.array([b.x1, b.y1, b.x2, b.y2])
-        image_data = Image.open(io.BytesIO(file))
-        image_array = np.array(image_data)
-        with sam_model_lock:
-            predictor.set_image(image_array)
-            masks, scores, logits = predictor.predict(
-                box=input_box,
-                multimask_output=False,
-            )
-            predictor.reset_image()
-        masks = [
-            {
-                "segmentation": compress_mask(np.array(mask)),
-                "stability_score": float(scores[idx]),
-                "bbox": [0, 0, 0, 0],
-                "area": np.sum(mask).item(),
-            }
-            for idx, mask in enumerate(masks)
-        ]
-        masks = sorted(masks, key=lambda x: x["stability_score"], reverse=True)
-        return {"code": 0, "data": masks[:]}
+        with registry.use("sam") as runtime:
+            state, scale = prompt_state(*embed(runtime, file), mask_size)
+            with runtime.prompt_pool.predictor(state) as predictor:
+                masks, scores, logits = predictor.predict(
+                    box=input_box * np.tile(scale, 2),
+                    multimask_output=False,
+                )
+        response.headers["X-Mask-Size"] = f"{masks.shape[1]}x{masks.shape[2]}"
+        return {"code": 0, "data": prompt_masks(masks, scores, encoding, fields)}
 
     @app.post("/api/everything")
-    async def api_everything(file: Annotated[bytes, File()]):
-        image_data = Image.open(io.BytesIO(file))
-        image_array = np.array(image_data)
-        masks = mask_generator.generate(image_array)
-        arg_idx = np.argsort([mask["stability_score"] for mask in masks])[::-1].tolist()
-        masks = [masks[i] for i in arg_idx]
-        for mask in masks:
-            mask["segmentation"] = compress_mask(mask["segmentation"])
-        return {"code": 0, "data": masks[:]}
+    def api_everything(
+        file: Annotated[bytes, File()],
+        response: Response,
+        encoding: Annotated[str, Depends(mask_format)],
+        settings: Annotated[Optional[str], Form()] = None,
+        stream: Optional[Literal["ndjson", "sse"]] = None,
+    ):
+        response.headers["Vary"] = "Accept"
+        try:
+            settings = GeneratorSettings.parse_raw(settings or "{}")
+        except ValidationError as e:
+            raise HTTPException(status_code=422, detail=e.errors())
+        image_array = np.array(Image.open(io.BytesIO(file)))
+
+        def encode_masks(masks):
+            masks.sort(key=lambda mask: mask["stability_score"], reverse=True)
+            for mask in masks:
+                mask["segmentation"] = encode_mask(mask["segmentation"], encoding)
+            return masks
+
+        if stream is None:
+            with registry.use("sam") as runtime:
+                with runtime.predictor_pool.predictor() as predictor:
+                    generator = MaskGenerator(
+                        predictor, crop_embedder(runtime, file), **settings.dict()
+                    )
+                    masks = generator.generate(image_array)
+            return {"code": 0, "data": encode_masks(masks)}
+
+        def messages():
+            with registry.use("sam") as runtime:
+                with runtime.predictor_pool.predictor() as predictor:
+                    generator = MaskGenerator(
+                        predictor, crop_embedder(runtime, file), **settings.dict()
+                    )
+                    for masks, done, total in generator.stream(image_array):
+                        message = json.dumps(
+                            {
+                                "code": 0,
+                                "data": encode_masks(masks),
+                                "progress": [done, total],
+                            }
+                        )
+                        if stream == "sse":
+                            yield f"data: {message}\n\n"
+                        else:
+                            yield message + "\n"
+
+        if stream == "sse":
+            media_type = "text/event-stream"
+        else:
+            media_type = "application/x-ndjson"
+        return StreamingResponse(
+            messages(), media_type=media_type, headers={"Vary": "Accept"}
+        )
 
     @app.post("/api/clip")
-    async def api_clip(
+    def api_clip(
         file: Annotated[bytes, File()],
         prompt: Annotated[str, Form(...)],
+        response: Response,
+        encoding: Annotated[str, Depends(mask_format)],
     ):
+        response.headers["Vary"] = "Accept"
         text_prompt = TextPrompt.parse_raw(prompt)
-        image_data = Image.open(io.BytesIO(file))
-        image_array = np.array(image_data)
-        masks = mask_generator.generate(image_array)
-        cropped_boxes = []
-        for mask in masks:
-            bobx = [int(x) for x in mask["bbox"]]
-            cropped_boxes.append(
-                segment_image(image_array, mask["segmentation"])[
-                    bobx[1] : bobx[1] + bobx[3], bobx[0] : bobx[0] + bobx[2]
-                ]
-            )
-        scores = retrieve(
-            cropped_boxes,
-            text_prompt.text,
-            model=clip_model,
-            preprocess=preprocess,
-            device=device,
-        )
-        top = scores.topk(5)
-        masks = [masks[i] for i in top.indices]
+        with registry.use("clip") as clip_runtime:
+            masks, size, features = clip_index(clip_runtime, file)
+            scores = clip_runtime.scorer.scores(features, text_prompt.text)
+        top = scores.topk(min(5, len(masks)))
+        masks = [unpack_mask(masks[i], size) for i in top.indices.tolist()]
         for mask in masks:
-            mask["segmentation"] = compress_mask(mask["segmentation"])
-        return {"code": 0, "data": masks[:]}
+            mask["segmentation"] = encode_mask(mask["segmentation"], encoding)
+        return {"code": 0, "data": masks}
+
+    @app.get("/api/clip/cache")
+    def api_clip_cache():
+        clip_runtime = registry.loaded("clip")
+        if clip_runtime is None:
+            return {"code": 0, "data": None}
+        return {
+            "code": 0,
+            "data": {**clip_runtime.indexes.stats(), **clip_runtime.scorer.stats()},
+        }
+
+    @app.get("/api/embedding/cache")
+    def api_embedding_cache():
+        runtime = registry.loaded("sam")
+        if runtime is None:
+            return {"code": 0, "data": None}
+        return {
+            "code": 0,
+            "data": {**runtime.embeddings.stats(), "encoder": runtime.encoder.stats()},
+        }
 
     @app.post("/api/embedding")
-    async def api_embedding(
+    def api_embedding(
         file: Annotated[bytes, File()],
     ):
-        image_data = Image.open(io.BytesIO(file))
-        image_array = np.array(image_data)
-        with sam_model_lock:
-            predictor.set_image(image_array)
-            image_embedding = predictor.get_image_embedding()
-            predictor.reset_image()
+        with registry.use("sam") as runtime:
+            (image_embedding, _, _), _ = embed(runtime, file)
         print(image_embedding.shape)
         return {"code": 0, "data": image_embedding.tolist()}
 
+    if preload:
+        registry.preload(preload)
+
     uvicorn.run(app, host=host, port=port)
 
 
@@ -204,7 +204,7 @@ const PoissonCanvas: React.FC<DisplayAssets> = ({ selectedCard }) => {
                 const result = await response.json();
                 if (result.success) {
                   console.log('Snapshot uploaded successfully');
-                  await blendBackgroundImage();
+                  await blendBackgroundImage(result.token);
                 } else {
                   console.error('Failed to upload snapshot');
                 }
@@ -222,7 +222,7 @@ const PoissonCanvas: React.FC<DisplayAssets> = ({ selectedCard }) => {
     }
   };
 
-  const blendBackgroundImage = async () => {
+  const blendBackgroundImage = async (token: string) => {
     const { backgroundCanvas } = canvasData;
     if (backgroundCanvas) {
       backgroundCanvas.toBlob(async (blob) => {
@@ -232,7 +232,7 @@ const PoissonCanvas: React.FC<DisplayAssets> = ({ selectedCard }) => {
 
           try {
             setLoading(true); // Start loading
-            const response = await fetch('http://0.0.0.0:8000/blend', {
+            const response = await fetch(`http://0.0.0.0:8000/blend?token=${encodeURIComponent(token)}`, {
               method: 'POST',
               body: formData,
             });
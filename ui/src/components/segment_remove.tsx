@@ -107,7 +107,7 @@ const Segment: React.FC<{
       img.onload = () => {
         drawImageOnCanvas(img);
       };
-      img.src = `http://localhost:3000/${maskFilename}`;
+      img.src = `http://0.0.0.0:8000/sam/preview/${maskFilename}`;
     }
   }, [test]);
 
@@ -11,8 +11,11 @@ export const config = {
 export default async function handler(
     req: NextApiRequest,
     res: NextApiResponse<Response>) {
+    const variant = req.query.variant
+        ? '?variant=' + encodeURIComponent(String(req.query.variant))
+        : '';
     const reader = await fetch(
-        utils.config.API_URL + '/sam_vit.onnx',
+        utils.config.API_URL + '/sam_vit.onnx' + variant,
         {
             method: 'GET',
         }